@@ -1,21 +1,64 @@
+import time
+
+# Отсчёт для журнала запуска: этапы старта пишутся в лог относительно этой точки
+STARTUP_STARTED = time.monotonic()
+
 import logging
+import signal
 from typing import Any
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, Router, types
 from aiogram.enums import ParseMode
 from aiogram.filters import Command
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.client.default import DefaultBotProperties
-from bs4 import BeautifulSoup
-import aiohttp
+from aiohttp import web
 import asyncio
+import bisect
 from datetime import datetime, timedelta
 import os
+import sys
 import json
+import hashlib
+from urllib.parse import urljoin
 from dotenv import load_dotenv
 from aiogram.types import ReplyKeyboardRemove
 from aiogram.types import CallbackQuery
 
+from profiling import (
+    configure_profiling,
+    handler_name_middleware,
+    profile_stage,
+    send_timing_middleware,
+    start_profiling,
+    timing_middleware,
+)
+from sources import HostUnavailable, close_sessions, fetch_page, load_sources
+from timetable import (
+    compare_teacher_schedules,
+    default_times,
+    describe_pair,
+    find_next_lesson,
+    find_pair,
+    find_pair_index,
+    format_occupants,
+    format_schedule,
+    get_pair_intervals,
+    get_time_table,
+    group_id,
+    invert_group_schedule,
+    merge_teacher_lessons,
+    monday_times,
+    natural_sort_key,
+    normalize_name,
+    parse_entry_date,
+    parse_index_page,
+    parse_schedule_html,
+    render_ics,
+    split_schedule,
+    teacher_id,
+)
+
 # Загрузка переменных окружения из .env файла
 load_dotenv()
 
@@ -26,72 +69,450 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Получение токена бота
-API_TOKEN = os.getenv('BOT_TOKEN')
-
-# Проверка наличия токена
-if not API_TOKEN:
-    raise ValueError("Токен бота не указан. Добавьте BOT_TOKEN в .env файл")
-
-# Инициализация бота
-bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+# Обработчики регистрируются в роутере; бот и диспетчер создаёт create_app,
+# поэтому импорт модуля не требует токена и ничего не загружает
+router = Router()
 
 # Глобальный словарь для хранения данных пользователей
 user_data = {}
 
+# Настройки реестра групп и преподавателей
+GROUPS_FILE = os.getenv('GROUPS_FILE', 'groups.json')
+TEACHERS_FILE = os.getenv('TEACHERS_FILE', 'teachers.json')
+# Как часто (в секундах) проверять изменения JSON-файлов
+REGISTRY_CHECK_INTERVAL = int(os.getenv('REGISTRY_CHECK_INTERVAL', '30'))
+
+# Автоматический поиск групп и преподавателей на сайте расписания
+DISCOVERY_ENABLED = os.getenv('DISCOVERY_ENABLED', '0') == '1'
+DISCOVERY_BASE_URL = os.getenv('DISCOVERY_BASE_URL', 'http://94.72.18.202:8083/')
+DISCOVERY_INDEX_PAGES = [
+    page.strip() for page in os.getenv('DISCOVERY_INDEX_PAGES', 'cg.htm,cp.htm').split(',') if page.strip()
+]
+DISCOVERY_INTERVAL = int(os.getenv('DISCOVERY_INTERVAL', '3600'))
+
+# Источники расписания (несколько колледжей или корпусов). Без sources.json
+# используется один источник из настроек выше
+SOURCES_FILE = os.getenv('SOURCES_FILE', 'sources.json')
+
+# Избранные группы и преподаватели пользователей
+FAVORITES_FILE = os.getenv('FAVORITES_FILE', 'favorites.json')
+MAX_FAVORITES = 5
+
+# Профилирование по запросу администратора
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+# Обновления дольше этого порога (в мс) попадают в лог во время профилирования
+SLOW_UPDATE_MS = int(os.getenv('SLOW_UPDATE_MS', '500'))
+# На сколько секунд включается профилирование по сигналу SIGUSR1/SIGUSR2
+PROFILE_SIGNAL_SECONDS = int(os.getenv('PROFILE_SIGNAL_SECONDS', '60'))
+
 # Словарь с группами и их ссылками
 groups = {}
 teachers = {}
 
-with open('groups.json', encoding='utf-8') as f:
-    groups = json.load(f)
-
-with open('teachers.json', encoding='utf-8') as f:
-    teachers = json.load(f)
-
-default_times = {
-    "1": "8:30-10:00",
-    "2": "10:10-11:40",
-    "3": "12:10-13:40",
-    "4": "13:50-15:20",
-    "5": "15:30-17:00",
-    "6": "17:10-18:40"
-}
+# Производные индексы реестра (пересобираются вместе с ним)
+group_ids = {}
+teacher_ids = {}
+url_entities = {}
+url_sources = {}
+# Имя в реестре -> имя на сайте (различаются, если имя пришлось дополнить источником)
+original_names = {}
+groups_keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+teachers_keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+
+# Последние найденные на сайтах группы и преподаватели: ID источника -> {имя: ссылка}
+discovered_groups = {}
+discovered_teachers = {}
+# Последний удачный результат каждой индексной страницы:
+# ID источника -> {ссылка на страницу: (группы, преподаватели)}
+discovered_pages = {}
+
+# Время изменения файлов реестра при последней загрузке
+registry_mtimes = None
+
+# Избранное: ID пользователя (строкой) -> [['group' | 'teacher', имя], ...]
+favorites = {}
 
-monday_times = {
-    "1": "8:30-9:00",
-    "2": "9:10-10:30",
-    "3": "10:40-12:00",
-    "4": "12:20-13:40",
-    "5": "13:50-15:10",
-    "6": "16:00-17:20",
-    "7": "17:30-18:50"
-}
 # Кэш для хранения расписания
 schedule_cache = {}
+# Последнее успешно загруженное расписание каждой страницы: ссылка -> [записи].
+# Очистка кэша его не трогает — оно отдаётся, пока сервер источника недоступен
+last_schedules = {}
+
+# HTTP-сервер с календарями .ics (пустой ICS_PORT — сервер выключен)
+ICS_HOST = os.getenv('ICS_HOST', '127.0.0.1')
+ICS_PORT = os.getenv('ICS_PORT', '')
+# Как часто (в секундах) обновлять расписания, на которые подписаны календари
+ICS_REFRESH_INTERVAL = int(os.getenv('ICS_REFRESH_INTERVAL', '900'))
+
+# Готовые календари: (тип, имя) -> {'version', 'etag', 'body'}
+ics_feeds = {}
+# Календари, которые сейчас строятся: (тип, имя) -> задача
+ics_pending = {}
+# Календари, которые не удалось построить: (тип, имя) -> когда можно пробовать снова
+ics_failed = {}
+# Пауза (в секундах) перед повторной попыткой после неудачи
+ICS_RETRY_INTERVAL = 300
+
+# Индексы аудиторий по всем загруженным расписаниям, отдельно для каждого источника.
+# ID источника -> {
+#     'slots': (дата, номер пары) -> {аудитория: {ссылка: (группа, преподаватель)}},
+#     'days': (аудитория, дата) -> {номер пары: {ссылка: (группа, преподаватель)}},
+#     'counts': аудитория -> число занятий в ней,
+#     'sorted': отсортированный список аудиторий
+# }
+room_indexes = {}
+# Что внесла в индекс каждая страница: ссылка -> (ID источника, [(дата, номер пары, аудитория)])
+room_contributions = {}
+# Как часто (в секундах) обходить страницы всех групп, чтобы индекс был полным
+GROUP_CRAWL_INTERVAL = int(os.getenv('GROUP_CRAWL_INTERVAL', '300'))
+
+# Режим, в котором расписания преподавателей строятся из страниц групп,
+# а страницы преподавателей (cpNN.htm) не загружаются
+DERIVE_TEACHERS = os.getenv('DERIVE_TEACHERS', '0') == '1'
+# Сколько страниц загружать с одного хоста одновременно
+CRAWL_CONCURRENCY = int(os.getenv('CRAWL_CONCURRENCY', '8'))
+
+# Настройки источника по умолчанию; в sources.json можно переопределить любое поле
+DEFAULT_SOURCE = {
+    'id': "main",
+    'title': os.getenv('SOURCE_TITLE', "Колледж"),
+    'groups_file': GROUPS_FILE,
+    'teachers_file': TEACHERS_FILE,
+    'base_url': DISCOVERY_BASE_URL,
+    'index_pages': DISCOVERY_INDEX_PAGES,
+    'discovery': DISCOVERY_ENABLED,
+    'encoding': "windows-1251",
+    'default_times': default_times,
+    'monday_times': monday_times,
+    'max_concurrency': CRAWL_CONCURRENCY,
+    'timeout': 30,
+}
 
-def get_weekday_name(offset=0):
-    """Возвращает 'пн', 'вт' и т.д. с учётом смещения дней"""
-    days = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
-    today = datetime.now() + timedelta(days=offset)
-    return days[today.weekday()]
+# Источники: ID -> настройки (см. sources.py)
+sources = {}
 
-def split_schedule(schedule_text, max_length=4096):
+# Занятия преподавателей со страниц групп: (ID источника, ФИО) -> {ссылка группы: [записи]}
+teacher_lessons = {}
+# Какие преподаватели внесены каждой страницей группы: ссылка -> {(ID источника, ФИО)}
+teacher_contributions = {}
+# Обход страниц групп по источникам: ID источника ->
+# {'loaded_at', 'missing' (сколько страниц без данных), 'lock', 'loaded' (первый обход завершён),
+#  'refresh' (запрошен внеочередной обход)}
+group_pages_state = {}
+
+# Реестр загружается в фоне после начала опроса Telegram; обновления ждут его здесь
+registry_ready = asyncio.Event()
+
+def build_keyboard(names, prefix, per_row, make_id):
     """
-    Разбивает текст расписания на части, каждая из которых не превышает max_length символов.
+    Клавиатура со списком групп или преподавателей по per_row кнопок в ряд.
+    В callback_data идёт идентификатор, а не имя: Telegram отклоняет всю
+    клавиатуру, если хоть одна callback_data длиннее 64 байт.
+    """
+    buttons = []
+    for name in names:
+        callback_data = f"{prefix}_{make_id(name)}"
+        if len(callback_data.encode('utf-8')) > 64:
+            logger.error(f"Слишком длинная callback_data для {name}, кнопка пропущена")
+            continue
+        buttons.append(InlineKeyboardButton(text=name, callback_data=callback_data))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+    for i in range(0, len(buttons), per_row):
+        keyboard.inline_keyboard.append(buttons[i:i+per_row])
+    return keyboard
+
+def build_registry(groups_map, teachers_map, url_sources_map, original_names_map):
+    """Строит реестр и все производные индексы: клавиатуры и таблицы идентификаторов"""
+    return {
+        'groups': groups_map,
+        'teachers': teachers_map,
+        'group_ids': {group_id(name): name for name in groups_map},
+        'teacher_ids': {teacher_id(name): name for name in teachers_map},
+        # Обратная таблица: ссылка -> ('group' | 'teacher', имя)
+        'url_entities': {
+            **{url: ('teacher', name) for name, url in teachers_map.items()},
+            **{url: ('group', name) for name, url in groups_map.items()},
+        },
+        # Ссылка -> ID источника
+        'url_sources': url_sources_map,
+        # Имя в реестре -> имя на сайте для дополненных источником имён
+        'original_names': original_names_map,
+        # Группы по 3 в ряд, преподаватели по 2 (так как ФИО длинные)
+        'groups_keyboard': build_keyboard(sorted(groups_map), "group", 3, group_id),
+        'teachers_keyboard': build_keyboard(sorted(teachers_map), "teacher", 2, teacher_id),
+    }
+
+def apply_registry(registry):
     """
-    parts = []
-    while len(schedule_text) > max_length:
-        # Находим последний перенос строки до max_length
-        split_index = schedule_text.rfind('\n', 0, max_length)
-        if split_index == -1:
-            # Если перенос строки не найден, просто делим по max_length
-            split_index = max_length
-        parts.append(schedule_text[:split_index])
-        schedule_text = schedule_text[split_index:].lstrip()
-    parts.append(schedule_text)
-    return parts
+    Подменяет реестр целиком. Функция синхронная, поэтому обработчики
+    никогда не увидят наполовину обновлённые индексы.
+    """
+    global groups, teachers, group_ids, teacher_ids, url_entities, url_sources, original_names, groups_keyboard, teachers_keyboard
+    groups = registry['groups']
+    teachers = registry['teachers']
+    group_ids = registry['group_ids']
+    teacher_ids = registry['teacher_ids']
+    url_entities = registry['url_entities']
+    url_sources = registry['url_sources']
+    original_names = registry['original_names']
+    groups_keyboard = registry['groups_keyboard']
+    teachers_keyboard = registry['teachers_keyboard']
+    # Расписания удалённых из реестра страниц больше не понадобятся
+    for url in [url for url in last_schedules if url not in url_entities]:
+        del last_schedules[url]
+    # Занятия удалённых страниц убираем из индекса аудиторий: сами они больше не загрузятся
+    for url in [url for url in room_contributions if url not in url_entities]:
+        update_room_index(url, [])
+    for url in [url for url in teacher_contributions if url not in url_entities]:
+        update_teacher_index(url, [])
+    logger.info(f"Реестр обновлён: {len(groups)} групп, {len(teachers)} преподавателей")
+
+def get_registry_mtimes():
+    """Время изменения файлов реестра всех источников (None, если файла нет)"""
+    mtimes = []
+    for path in [path for source in sources.values() for path in (source['groups_file'], source['teachers_file'])]:
+        try:
+            mtimes.append(os.path.getmtime(path))
+        except OSError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+def load_json_file(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def init_sources():
+    """Загружает список источников. Возвращает False, если sources.json не удалось прочитать"""
+    global sources
+    try:
+        sources = load_sources(SOURCES_FILE, DEFAULT_SOURCE)
+    except (OSError, ValueError, KeyError) as e:
+        logger.error(f"Не удалось загрузить источники из {SOURCES_FILE}: {e}")
+        return False
+    logger.info(f"Источники расписания: {', '.join(sources)}")
+    return True
+
+def default_source():
+    return next(iter(sources.values()))
+
+def source_for_url(url):
+    return sources.get(url_sources.get(url)) or default_source()
+
+def entity_source(kind, name):
+    return source_for_url((groups if kind == 'group' else teachers).get(name))
+
+def unique_name(name, source, taken):
+    """
+    Имя, дополненное коротким ID источника, которого ещё нет в taken.
+    Название источника не используется: имя попадает в кнопки и их callback_data
+    """
+    for candidate in (name, f"{name} ({source['id']})"):
+        if candidate not in taken:
+            return candidate
+    number = 2
+    while f"{name} ({source['id']} {number})" in taken:
+        number += 1
+    return f"{name} ({source['id']} {number})"
+
+def reload_registry():
+    """
+    Перечитывает groups.json и teachers.json всех источников и подменяет реестр.
+    Найденные на сайте записи дополняют файлы, но не перекрывают их.
+    При ошибке чтения остаётся прежний реестр.
+    """
+    global registry_mtimes
+    mtimes = get_registry_mtimes()
+    all_groups = {}
+    all_teachers = {}
+    all_url_sources = {}
+    all_original_names = {}
+    try:
+        for source in sources.values():
+            file_groups = load_json_file(source['groups_file'])
+            file_teachers = load_json_file(source['teachers_file'])
+            for entities, found, from_file in (
+                (all_groups, discovered_groups.get(source['id'], {}), file_groups),
+                (all_teachers, discovered_teachers.get(source['id'], {}), file_teachers),
+            ):
+                for original_name, url in {**found, **from_file}.items():
+                    # Одинаковые имена из разных источников различаем по источнику
+                    name = unique_name(original_name, source, entities)
+                    entities[name] = url
+                    all_url_sources[url] = source['id']
+                    if name != original_name:
+                        all_original_names[name] = original_name
+    except (OSError, ValueError) as e:
+        logger.error(f"Не удалось загрузить реестр: {e}")
+        return False
+
+    registry_mtimes = mtimes
+    apply_registry(build_registry(all_groups, all_teachers, all_url_sources, all_original_names))
+    return True
+
+async def fetch_index_page(page_url, source):
+    status, html = await fetch_page(page_url, source)
+    if status != 200:
+        raise RuntimeError(f"статус {status}")
+    return html
+
+async def discover_entities(source):
+    """
+    Параллельно обходит индексные страницы сайта источника. Возвращает для каждой
+    страницы найденные на ней (группы, преподавателей) или None, если страницу
+    не удалось загрузить либо ссылок на ней нет.
+    """
+    page_urls = [urljoin(source['base_url'], page) for page in source['index_pages']]
+    pages = await asyncio.gather(
+        *(fetch_index_page(url, source) for url in page_urls),
+        return_exceptions=True
+    )
+
+    results = {}
+    for page_url, html in zip(page_urls, pages):
+        if isinstance(html, BaseException):
+            logger.warning(f"Не удалось загрузить индексную страницу {page_url}: {html}")
+            results[page_url] = None
+            continue
+        page_groups, page_teachers = parse_index_page(html, page_url)
+        # Пустая страница скорее означает ошибку сайта, чем пустое расписание
+        results[page_url] = (page_groups, page_teachers) if page_groups or page_teachers else None
+    return results
+
+async def discover_source(source):
+    """
+    Обновляет найденные на сайте источника записи. Для страниц, которые не удалось
+    загрузить, остаётся их прежний результат. Возвращает True, если записи изменились.
+    """
+    try:
+        results = await discover_entities(source)
+    except Exception as e:
+        logger.error(f"Ошибка при поиске групп и преподавателей ({source['id']}): {e}")
+        return False
+
+    previous = discovered_pages.get(source['id'], {})
+    pages = {
+        page_url: result if result is not None else previous[page_url]
+        for page_url, result in results.items() if result is not None or page_url in previous
+    }
+    if pages == previous:
+        return False
+    discovered_pages[source['id']] = pages
+
+    found_groups = {}
+    found_teachers = {}
+    for page_groups, page_teachers in pages.values():
+        found_groups.update(page_groups)
+        found_teachers.update(page_teachers)
+    discovered_groups[source['id']] = found_groups
+    discovered_teachers[source['id']] = found_teachers
+    logger.info(f"Найдено на сайте {source['id']}: {len(found_groups)} групп, {len(found_teachers)} преподавателей")
+    return True
+
+async def run_discovery():
+    """Обновляет найденные на сайтах записи (все источники параллельно) и пересобирает реестр"""
+    results = await asyncio.gather(
+        *(discover_source(source) for source in sources.values() if source['discovery'])
+    )
+    if any(results):
+        reload_registry()
+
+async def watch_registry_files():
+    """Перезагружает реестр при изменении JSON-файлов без перезапуска бота"""
+    while True:
+        await asyncio.sleep(REGISTRY_CHECK_INTERVAL)
+        if get_registry_mtimes() != registry_mtimes:
+            logger.info("Файлы реестра изменились, перезагружаем")
+            reload_registry()
+
+async def discover_entities_periodically():
+    """Периодически ищет новые группы и преподавателей на сайте"""
+    while True:
+        await run_discovery()
+        await asyncio.sleep(DISCOVERY_INTERVAL)
+
+def get_room_index(source_id):
+    return room_indexes.setdefault(source_id, {'slots': {}, 'days': {}, 'counts': {}, 'sorted': []})
+
+def update_room_index(url, schedule):
+    """
+    Заменяет вклад страницы url в индекс аудиторий её источника. Вызывается при
+    каждой загрузке страницы, поэтому запросы /room и /free не перебирают расписания.
+    """
+    old_source_id, old_contributions = room_contributions.pop(url, (None, []))
+    if old_contributions:
+        index = get_room_index(old_source_id)
+        room_slots, room_days, room_counts = index['slots'], index['days'], index['counts']
+        rooms_before = set(room_counts)
+        for day, pair_number, room in old_contributions:
+            rooms = room_slots.get((day, pair_number), {})
+            rooms.get(room, {}).pop(url, None)
+            if not rooms.get(room, True):
+                del rooms[room]
+            if not rooms:
+                room_slots.pop((day, pair_number), None)
+            pairs = room_days.get((room, day), {})
+            pairs.get(pair_number, {}).pop(url, None)
+            if not pairs.get(pair_number, True):
+                del pairs[pair_number]
+            if not pairs:
+                room_days.pop((room, day), None)
+            room_counts[room] = room_counts.get(room, 1) - 1
+            if room_counts[room] <= 0:
+                del room_counts[room]
+        if room_counts.keys() != rooms_before:
+            index['sorted'] = sorted(room_counts, key=natural_sort_key)
+
+    kind, name = url_entities.get(url, (None, None))
+    source_id = url_sources.get(url)
+    if not kind or not source_id:
+        return
+
+    index = get_room_index(source_id)
+    room_slots, room_days, room_counts = index['slots'], index['days'], index['counts']
+    rooms_before = set(room_counts)
+    # Одна и та же пара в аудитории может встречаться на странице несколько раз (подгруппы)
+    contributions = set()
+    for entry in schedule:
+        room = entry['classroom']
+        day = parse_entry_date(entry['date'])
+        if room == "—" or entry['subject'] == "Нет пары" or not day:
+            continue
+        # На страницах преподавателей в поле subject записана группа
+        occupant = (name, entry['teacher']) if kind == 'group' else (entry['subject'], name)
+        pair_number = entry['pair_number']
+        if (day, pair_number, room) in contributions:
+            group, teacher = room_slots[(day, pair_number)][room][url]
+            occupant = (group, f"{teacher}, {occupant[1]}") if kind == 'group' else (f"{group}, {occupant[0]}", name)
+        room_slots.setdefault((day, pair_number), {}).setdefault(room, {})[url] = occupant
+        room_days.setdefault((room, day), {}).setdefault(pair_number, {})[url] = occupant
+        if (day, pair_number, room) not in contributions:
+            room_counts[room] = room_counts.get(room, 0) + 1
+            contributions.add((day, pair_number, room))
+    if contributions:
+        room_contributions[url] = (source_id, contributions)
+
+    # Список аудиторий пересортировываем, только если он изменился
+    if room_counts.keys() != rooms_before:
+        index['sorted'] = sorted(room_counts, key=natural_sort_key)
+
+def update_teacher_index(url, schedule):
+    """Заменяет вклад страницы группы url в расписания преподавателей"""
+    for teacher in teacher_contributions.pop(url, ()):
+        teacher_lessons[teacher].pop(url, None)
+        if not teacher_lessons[teacher]:
+            del teacher_lessons[teacher]
+
+    kind, name = url_entities.get(url, (None, None))
+    if kind != 'group':
+        return
+    # Однофамильцы из разных источников — разные преподаватели
+    source_id = url_sources.get(url)
+    lessons = invert_group_schedule(name, schedule)
+    for teacher, records in lessons.items():
+        teacher_lessons.setdefault((source_id, teacher), {})[url] = records
+    if lessons:
+        teacher_contributions[url] = {(source_id, teacher) for teacher in lessons}
 
 async def get_schedule(group_url):
     # Проверяем, есть ли данные в кэше и не устарели ли они
@@ -101,91 +522,286 @@ async def get_schedule(group_url):
             logger.info(f"Используем кэшированное расписание для {group_url}")
             return cached_data['schedule']
 
+    # Устаревшее расписание лучше пустого, пока сервер источника недоступен
+    stale_schedule = last_schedules.get(group_url, [])
+    source = source_for_url(group_url)
+
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(group_url) as response:
-                if response.status == 200:
-                    html = await response.text(encoding='windows-1251')
-                    soup = BeautifulSoup(html, 'html.parser')
-
-                    tables = soup.find_all('table')
-                    if not tables:
-                        logger.warning("Таблицы на странице не найдены.")
-                        return []
-
-                    schedule = []
-                    current_date = None
-
-                    for table in tables:
-                        rows = table.find_all('tr')
-                        for row in rows[1:]:  # Пропускаем заголовок
-                            cells = row.find_all('td')
-
-                            if not cells:
-                                continue
-
-                            # Проверяем, является ли строка заголовком
-                            is_header = any(
-                                cell.text.strip() in ["День", "Пара", "&nbsp;"]
-                                for cell in cells
-                            )
-                            if is_header:
-                                continue  # Пропускаем заголовок
-
-                            # Если строка содержит дату и день недели
-                            if len(cells) >= 1 and cells[0].get('rowspan'):
-                                current_date = cells[0].text.strip().replace('\n', ' ')
-                                logger.info(f"Найдена дата: {current_date}")
-
-                            # Определяем номер пары и ячейку с деталями
-                            pair_number = None
-                            details_cell = None
-                            
-                            if len(cells) >= 3:  # Строка с датой
-                                pair_number = cells[1].text.strip()
-                                details_cell = cells[2]
-                            elif len(cells) >= 2:  # Обычная строка
-                                pair_number = cells[0].text.strip()
-                                details_cell = cells[1]
-                            
-                            if not pair_number or not details_cell or not details_cell.text.strip():
-                                continue
-
-                            # Извлекаем данные о паре
-                            subject = details_cell.find('a', class_='z1')
-                            classroom = details_cell.find('a', class_='z2')
-                            teacher = details_cell.find('a', class_='z3')
-
-                            # Определяем время пары
-                            is_monday = current_date and ("Пн" in current_date or "понедельник" in current_date.lower())
-                            time_table = monday_times if is_monday else default_times
-                            pair_time = time_table.get(pair_number, "—")
-
-                            schedule.append({
-                                'date': current_date,
-                                'pair_number': pair_number,
-                                'pair_time': pair_time,
-                                'subject': subject.text.strip() if subject else "Нет пары",
-                                'classroom': classroom.text.strip() if classroom else "—",
-                                'teacher': teacher.text.strip() if teacher else "—"
-                            })
-
-                    # Сохраняем расписание в кэше
-                    schedule_cache[group_url] = {
-                        'schedule': schedule,
-                        'timestamp': datetime.now()
-                    }
-
-                    logger.info(f"Расписание успешно загружено для {group_url}")
-                    return schedule
-                else:
-                    logger.error(f"Ошибка при загрузке страницы: {response.status}")
-                    return []
+        with profile_stage("fetch"):
+            status, html = await fetch_page(group_url, source)
+
+        if status == 200:
+            with profile_stage("parse"):
+                schedule = parse_schedule_html(html, source['time_tables'])
+            if schedule is None:
+                return []
+
+            # Сохраняем расписание в кэше
+            schedule_cache[group_url] = {
+                'schedule': schedule,
+                'timestamp': datetime.now()
+            }
+            last_schedules[group_url] = schedule
+            update_room_index(group_url, schedule)
+            if DERIVE_TEACHERS:
+                update_teacher_index(group_url, schedule)
+
+            logger.info(f"Расписание успешно загружено для {group_url}")
+            return schedule
+        else:
+            logger.error(f"Ошибка при загрузке страницы: {status}")
+            return stale_schedule
+    except HostUnavailable as e:
+        logger.warning(f"Хост {e} на паузе, расписание {group_url} не загружается")
+        return stale_schedule
     except Exception as e:
         logger.error(f"Ошибка в функции get_schedule: {e}")
-        return []
+        return stale_schedule
+
+def get_group_pages_state(source_id):
+    return group_pages_state.setdefault(source_id, {
+        'loaded_at': None,
+        'missing': 0,
+        'lock': asyncio.Lock(),
+        'loaded': asyncio.Event(),
+        'refresh': asyncio.Event(),
+    })
+
+async def load_group_pages(source):
+    """
+    Загружает страницы всех групп источника, обновляя индексы аудиторий и преподавателей.
+    Одновременность запросов ограничивается для каждого хоста в fetch_page,
+    поэтому медленный источник не задерживает загрузку остальных.
+    """
+    state = get_group_pages_state(source['id'])
+    async with state['lock']:
+        urls = [url for url in groups.values() if url_sources.get(url) == source['id']]
+        await asyncio.gather(*(get_schedule(url) for url in urls))
+        state['loaded_at'] = datetime.now()
+        state['missing'] = sum(1 for url in urls if url not in last_schedules)
+        state['loaded'].set()
+        logger.info(f"Загружены страницы {len(urls) - state['missing']} из {len(urls)} групп ({source['id']})")
+
+async def crawl_group_pages_periodically(source):
+    """
+    Обходит страницы всех групп источника каждые GROUP_CRAWL_INTERVAL секунд
+    (или раньше, если запрошено обновление), чтобы /free видел все занятия,
+    а не только недавно запрошенные расписания. По этому же обходу строятся
+    расписания преподавателей в режиме DERIVE_TEACHERS.
+    """
+    state = get_group_pages_state(source['id'])
+    while True:
+        state['refresh'].clear()
+        try:
+            await load_group_pages(source)
+        except Exception as e:
+            logger.error(f"Ошибка при обходе страниц групп ({source['id']}): {e}")
+        try:
+            await asyncio.wait_for(state['refresh'].wait(), GROUP_CRAWL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def get_derived_teacher_schedule(teacher_name):
+    """
+    Расписание преподавателя, собранное со страниц групп его источника.
+    Страницы здесь не загружаются: индекс обновляет фоновый обход, ждём только первый
+    """
+    source = entity_source('teacher', teacher_name)
+    state = get_group_pages_state(source['id'])
+    if not state['loaded'].is_set():
+        await state['loaded'].wait()
+    original_name = original_names.get(teacher_name, teacher_name)
+    lessons = teacher_lessons.get((source['id'], normalize_name(original_name)), {})
+    return merge_teacher_lessons([record for records in lessons.values() for record in records])
+
+async def get_entity_schedule(kind, name):
+    """Расписание группы или преподавателя из реестра по имени"""
+    if kind == 'teacher' and DERIVE_TEACHERS:
+        return await get_derived_teacher_schedule(name)
+    entities = groups if kind == 'group' else teachers
+    return await get_schedule(entities[name])
+
+def check_teacher_fixtures(directory, source):
+    """
+    Сверяет расписания преподавателей, выведенные из страниц групп, с настоящими
+    страницами преподавателей. В каталоге лежат сохранённые с сайта источника
+    cgNN.htm и cpNN.htm. Возвращает код выхода: 0, если расхождений нет.
+    """
+    # Имена файлов у разных источников совпадают, поэтому берём страницы одного источника
+    page_entities = {
+        url.rsplit("/", 1)[-1]: (kind, original_names.get(name, name))
+        for url, (kind, name) in url_entities.items() if url_sources.get(url) == source['id']
+    }
+    pages = {}
+    for file_name in sorted(os.listdir(directory)):
+        if file_name in page_entities:
+            with open(os.path.join(directory, file_name), encoding=source['encoding']) as f:
+                pages[file_name] = parse_schedule_html(f.read(), source['time_tables']) or []
+
+    lessons = {}
+    for file_name, schedule in pages.items():
+        kind, name = page_entities[file_name]
+        if kind == 'group':
+            for teacher, records in invert_group_schedule(name, schedule).items():
+                lessons.setdefault(teacher, []).extend(records)
+
+    checked = 0
+    failed = 0
+    for file_name, schedule in pages.items():
+        kind, name = page_entities[file_name]
+        if kind != 'teacher':
+            continue
+        checked += 1
+        derived = merge_teacher_lessons(lessons.get(normalize_name(name), []))
+        differences = compare_teacher_schedules(derived, schedule)
+        if differences:
+            failed += 1
+            print(f"{name} ({file_name}): {len(differences)} расхождений")
+            for difference in differences:
+                print(f"  {difference}")
+
+    print(f"Проверено преподавателей: {checked}, с расхождениями: {failed}")
+    return 1 if failed else 0
+
+async def refresh_ics_feed(kind, name):
+    """
+    Перестраивает календарь, только если расписание изменилось.
+    Запросы к серверу календарей сами по себе расписание не загружают.
+    """
+    if name not in (groups if kind == 'group' else teachers):
+        # Группа или преподаватель пропали из реестра
+        ics_feeds.pop((kind, name), None)
+        return
+
+    schedule = await get_entity_schedule(kind, name)
+    # Пустой ответ — либо пар действительно нет, либо страницу не удалось загрузить.
+    # Выведенные расписания преподавателей пустыми бывают только при отсутствии пар
+    loaded = kind == 'teacher' and DERIVE_TEACHERS or (groups if kind == 'group' else teachers).get(name) in last_schedules
+    if not schedule and not loaded:
+        if (kind, name) not in ics_feeds:
+            ics_failed[(kind, name)] = time.monotonic() + ICS_RETRY_INTERVAL
+        return  # Оставляем прежний календарь
+    ics_failed.pop((kind, name), None)
+
+    version = hashlib.sha1(
+        json.dumps(schedule, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+    feed = ics_feeds.get((kind, name))
+    if feed and feed['version'] == version:
+        return
+
+    body = render_ics(kind, name, schedule, entity_source(kind, name)['time_tables']).encode('utf-8')
+    ics_feeds[(kind, name)] = {
+        'version': version,
+        'etag': f'"{hashlib.sha1(body).hexdigest()}"',
+        'body': body,
+    }
+    logger.info(f"Календарь для {name} обновлён")
+
+async def build_ics_feed_in_background(kind, name):
+    try:
+        await refresh_ics_feed(kind, name)
+    except Exception as e:
+        logger.error(f"Ошибка при построении календаря для {name}: {e}")
+        ics_failed[(kind, name)] = time.monotonic() + ICS_RETRY_INTERVAL
+    finally:
+        ics_pending.pop((kind, name), None)
 
-@dp.message(Command("remove"))
+async def ics_feed_handler(request):
+    """
+    GET /ics/{group|teacher}/{имя}.ics — отдаёт заранее построенный календарь.
+    Только самый первый запрос ждёт построения; дальше календарь обновляется в фоне
+    """
+    await registry_ready.wait()
+    kind = request.match_info['kind']
+    name = request.match_info['name']
+    if kind not in ('group', 'teacher') or name not in (groups if kind == 'group' else teachers):
+        raise web.HTTPNotFound(text="Группа или преподаватель не найдены")
+
+    feed = ics_feeds.get((kind, name))
+    if feed is None:
+        # Недавно не удалось построить — не загружаем страницу на каждый опрос
+        retry_in = ics_failed.get((kind, name), 0) - time.monotonic()
+        if retry_in > 0:
+            return web.Response(status=503, headers={'Retry-After': str(int(retry_in) + 1)}, text="Расписание недоступно")
+        # Первый запрос: строим календарь сразу — приложения проверяют ссылку при подписке.
+        # Одновременные первые запросы ждут одно построение; отмена запроса его не прерывает
+        task = ics_pending.get((kind, name))
+        if task is None:
+            task = ics_pending[(kind, name)] = asyncio.create_task(build_ics_feed_in_background(kind, name))
+        await asyncio.shield(task)
+        feed = ics_feeds.get((kind, name))
+        if feed is None:
+            retry_in = max(ics_failed.get((kind, name), 0) - time.monotonic(), 0)
+            return web.Response(status=503, headers={'Retry-After': str(int(retry_in) + 1)}, text="Расписание недоступно")
+
+    if_none_match = request.headers.get('If-None-Match', "")
+    if feed['etag'] in if_none_match or if_none_match.strip() == "*":
+        return web.Response(status=304, headers={'ETag': feed['etag']})
+
+    return web.Response(
+        body=feed['body'],
+        content_type='text/calendar',
+        charset='utf-8',
+        headers={'ETag': feed['etag'], 'Cache-Control': 'no-cache'}
+    )
+
+async def start_ics_server():
+    app = web.Application()
+    app.router.add_get('/ics/{kind}/{name}.ics', ics_feed_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, ICS_HOST, int(ICS_PORT)).start()
+    logger.info(f"Сервер календарей запущен на {ICS_HOST}:{ICS_PORT}")
+    return runner
+
+async def refresh_ics_feeds_periodically():
+    """Обновляет все календари, которые уже запрашивались"""
+    while True:
+        await asyncio.sleep(ICS_REFRESH_INTERVAL)
+        for kind, name in list(ics_feeds):
+            try:
+                await refresh_ics_feed(kind, name)
+            except Exception as e:
+                logger.error(f"Ошибка при обновлении календаря для {name}: {e}")
+
+def load_favorites():
+    global favorites
+    try:
+        favorites = load_json_file(FAVORITES_FILE)
+    except FileNotFoundError:
+        favorites = {}
+    except (OSError, ValueError) as e:
+        logger.error(f"Не удалось загрузить избранное: {e}")
+        favorites = {}
+
+def save_favorites():
+    """Записывает избранное во временный файл и атомарно подменяет им основной"""
+    tmp_path = f"{FAVORITES_FILE}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(favorites, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, FAVORITES_FILE)
+    except OSError as e:
+        logger.error(f"Не удалось сохранить избранное: {e}")
+
+def get_favorites(user_id):
+    """Избранное пользователя без записей, пропавших из реестра"""
+    return [
+        (kind, name) for kind, name in favorites.get(str(user_id), [])
+        if name in (groups if kind == 'group' else teachers)
+    ]
+
+def favorite_callback(period, kind, name):
+    entity_id = group_id(name) if kind == 'group' else teacher_id(name)
+    callback_data = f"fav_{period}_{kind}_{entity_id}"
+    # Идентификаторы короткие, но проверяем лимит Telegram, как и в show_category_options
+    if len(callback_data.encode('utf-8')) > 64:
+        logger.error(f"Слишком длинная callback_data для {name}")
+        return None
+    return callback_data
+
+@router.message(Command("remove"))
 async def remove_keyboard(message: Message):
     await message.answer(
         "Старая клавиатура удалена",
@@ -193,36 +809,53 @@ async def remove_keyboard(message: Message):
     )
 
 # Команда /start
-@dp.message(Command("start"))
-async def send_welcome(message: Message):
-    logger.info(f"Пользователь {message.from_user.id} запустил бота.")
+@router.message(Command("start"))
+async def send_welcome(message: Message, user_id=None):
+    # При возврате в меню из callback сообщение отправлено ботом, поэтому ID передаётся явно
+    user_id = user_id or message.from_user.id
+    logger.info(f"Пользователь {user_id} запустил бота.")
     
-    # Создаем клавиатуру с тремя кнопками
+    # Избранное — по одной строке кнопок «сегодня / завтра / неделя» на запись
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text=f"⭐ {name}: сегодня", callback_data=favorite_callback("today", kind, name)),
+            InlineKeyboardButton(text="завтра", callback_data=favorite_callback("tomorrow", kind, name)),
+            InlineKeyboardButton(text="неделя", callback_data=favorite_callback("week", kind, name))
+        ]
+        for kind, name in get_favorites(user_id)
+        if favorite_callback("tomorrow", kind, name)
+    ])
+
+    # Создаем клавиатуру с основными кнопками
+    keyboard.inline_keyboard += [
         [InlineKeyboardButton(text="🆘 Помощь", callback_data="help_command")],
         [InlineKeyboardButton(text="🔄 Обновить расписание", callback_data="refresh_cache")],  # Новая кнопка
         [InlineKeyboardButton(text="📅 Выберите день", callback_data="select_day")],
         [InlineKeyboardButton(text="🏫 Список групп", callback_data="groups_list")],
         [InlineKeyboardButton(text="👨‍🏫 Список преподавателей", callback_data="teachers_list")]
-    ])
+    ]
     
     await message.reply(
         "Привет! Я бот для расписания. Выбери действие:",
         reply_markup=keyboard
     )
 
-@dp.callback_query(lambda c: c.data == "refresh_cache")
+@router.callback_query(lambda c: c.data == "refresh_cache")
 async def refresh_cache_handler(callback: CallbackQuery):
     global schedule_cache
     schedule_cache = {}  # Очищаем кэш
+    # Внеочередной обход страниц групп: по ним строятся выведенные расписания преподавателей.
+    # Повторные нажатия во время обхода объединяются в один
+    for state in group_pages_state.values():
+        state['refresh'].set()
     logger.info(f"Кэш расписания очищен по запросу пользователя {callback.from_user.id}")
     await callback.answer("✅ Расписание обновлено", show_alert=True)
     
     # Возвращаем пользователя в главное меню
-    await send_welcome(callback.message)
+    await send_welcome(callback.message, user_id=callback.from_user.id)
 
 # Команда /schedule
-@dp.message(Command("schedule"))
+@router.message(Command("schedule"))
 async def send_schedule(message: Message):
     try:
         # Получаем название группы из сообщения
@@ -231,21 +864,10 @@ async def send_schedule(message: Message):
 
         # Ищем группу в словаре
         if group_name in groups:
-            group_url = groups[group_name]
-            schedule = await get_schedule(group_url)
+            schedule = await get_entity_schedule('group', group_name)
 
             if schedule:
-                response = f"📅 Расписание для группы {group_name}:\n"
-                current_date = None
-
-                for entry in schedule:
-                    if entry['date'] != current_date:
-                        response += f"\n📅 <b>{entry['date']}</b>\n"
-                        current_date = entry['date']
-                    response += f"  🕒 Пара {entry['pair_number']} ({entry['pair_time']}):\n"
-                    response += f"      📚 Дисциплина: {entry['subject']}\n"
-                    response += f"      🏫 Аудитория: {entry['classroom']}\n"
-                    response += f"      👨‍🏫 Преподаватель: {entry['teacher']}\n\n"
+                response = format_schedule('group', f"📅 Расписание для группы {group_name}:\n", schedule)
 
                 # Разбиваем расписание на части
                 schedule_parts = split_schedule(response)
@@ -269,7 +891,7 @@ async def send_schedule(message: Message):
         logger.error(f"Ошибка в команде /schedule: {e}")
 
 # Команда /teacher
-@dp.message(Command("teacher"))
+@router.message(Command("teacher"))
 async def send_teacher_schedule(message: Message):
     try:
         # Получаем имя преподавателя из сообщения
@@ -278,21 +900,10 @@ async def send_teacher_schedule(message: Message):
 
         # Ищем преподавателя в словаре
         if teacher_name in teachers:
-            teacher_url = teachers[teacher_name]
-            schedule = await get_schedule(teacher_url)
+            schedule = await get_entity_schedule('teacher', teacher_name)
 
             if schedule:
-                response = f"📅 Расписание для преподавателя {teacher_name}:\n"
-                current_date = None
-
-                for entry in schedule:
-                    if entry['date'] != current_date:
-                        response += f"\n📅 <b>{entry['date']}</b>\n"
-                        current_date = entry['date']
-                    response += f"  🕒 Пара {entry['pair_number']} ({entry['pair_time']})\n"
-                    response += f"      📚 Дисциплина: {entry['teacher']}\n"
-                    response += f"      👥 Группа: {entry['subject']}\n"
-                    response += f"      🏫 Аудитория: {entry['classroom']}\n\n"
+                response = format_schedule('teacher', f"📅 Расписание для преподавателя {teacher_name}:\n", schedule)
 
                 # Разбиваем расписание на части
                 schedule_parts = split_schedule(response)
@@ -318,7 +929,7 @@ async def send_teacher_schedule(message: Message):
 # Остальные функции (help, teachers, groups) остаются без изменений
 
 # Команда /help
-@dp.message(Command("help"))
+@router.message(Command("help"))
 async def send_help(message: Message):
     logger.info(f"Пользователь {message.from_user.id} запросил помощь.")
     help_text = (
@@ -328,66 +939,46 @@ async def send_help(message: Message):
         "📅 <b>Расписание:</b>\n"
         "🔹 /schedule [группа] - Расписание группы на неделю\n"
         "🔹 /teacher [ФИО] - Расписание преподавателя\n"
-        "🔹 /day [группа/ФИО] [день] - Расписание на конкретный день\n\n"
+        "🔹 /day [группа/ФИО] [день] - Расписание на конкретный день\n"
+        "🔹 /now [группа/ФИО] - Текущая пара\n"
+        "🔹 /next [группа/ФИО] - Следующая пара\n\n"
         "📋 <b>Списки:</b>\n"
         "🔹 /groups - Все доступные группы\n"
         "🔹 /teachers - Все преподаватели\n\n"
+        "⭐ <b>Избранное:</b>\n"
+        "🔹 /fav [группа/ФИО] - Добавить в избранное (кнопки появятся в /start)\n"
+        "🔹 /unfav [группа/ФИО] - Удалить из избранного\n\n"
+        "🏫 <b>Аудитории:</b>\n"
+        "🔹 /room [аудитория] [источник] - Занятость аудитории сегодня\n"
+        "🔹 /free [пара] [источник] - Свободные аудитории\n"
+        "🔹 /sources - Источники расписания\n\n"
         "📌 <b>Примеры:</b>\n"
         "<code>/schedule СОД23-1</code>\n"
         "<code>/teacher Волошин Р.Н.</code>\n"
         "<code>/day ИСп21-2К пн</code>\n"
-        "<code>/day Григорян Н.А. среда</code>"
+        "<code>/day Григорян Н.А. среда</code>\n"
+        "<code>/now ИСп21-2К</code>\n"
+        "<code>/room 301</code>\n"
+        "<code>/free 3</code>"
     )
     await message.reply(help_text, parse_mode=ParseMode.HTML)
 
 # Команда /groups
-@dp.message(Command("groups"))
+@router.message(Command("groups"))
 async def send_groups(message: Message):
     logger.info(f"Пользователь {message.from_user.id} запросил список групп.")
-    
-    # Создаем клавиатуру с кнопками
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[])
-    
-    # Группируем кнопки по 3 в ряд
-    group_buttons = []
-    for group in sorted(groups.keys()):
-        group_buttons.append(InlineKeyboardButton(text=group, callback_data=f"group_{group}"))
-        if len(group_buttons) == 3:
-            keyboard.inline_keyboard.append(group_buttons)
-            group_buttons = []
-    
-    # Добавляем оставшиеся кнопки
-    if group_buttons:
-        keyboard.inline_keyboard.append(group_buttons)
-    
-    await message.reply("🏫 Выберите группу:", reply_markup=keyboard)
+    await message.reply("🏫 Выберите группу:", reply_markup=groups_keyboard)
 
 # Команда /teachers
-@dp.message(Command("teachers"))
+@router.message(Command("teachers"))
 async def send_teachers(message: Message):
     logger.info(f"Пользователь {message.from_user.id} запросил список преподавателей.")
-    
-    # Создаем клавиатуру с кнопками
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[])
-    
-    # Группируем кнопки по 2 в ряд (так как ФИО длинные)
-    teacher_buttons = []
-    for teacher in sorted(teachers.keys()):
-        teacher_buttons.append(InlineKeyboardButton(text=teacher, callback_data=f"teacher_{teacher}"))
-        if len(teacher_buttons) == 2:
-            keyboard.inline_keyboard.append(teacher_buttons)
-            teacher_buttons = []
-    
-    # Добавляем оставшиеся кнопки
-    if teacher_buttons:
-        keyboard.inline_keyboard.append(teacher_buttons)
-    
-    await message.reply("👨‍🏫 Выберите преподавателя:", reply_markup=keyboard)
+    await message.reply("👨‍🏫 Выберите преподавателя:", reply_markup=teachers_keyboard)
 
 # Глобальный словарь для хранения состояния пользователя
 user_state = {}
 
-@dp.callback_query(lambda c: c.data == "select_day")
+@router.callback_query(lambda c: c.data == "select_day")
 async def select_day(callback: CallbackQuery):
     try:
         days = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота"]
@@ -407,7 +998,7 @@ async def select_day(callback: CallbackQuery):
         logger.error(f"Ошибка в select_day: {e}")
         await callback.answer("Произошла ошибка. Попробуйте снова.")
 
-@dp.callback_query(lambda c: c.data.startswith("day_") and len(c.data.split("_")) == 2)
+@router.callback_query(lambda c: c.data.startswith("day_") and len(c.data.split("_")) == 2)
 async def day_selected(callback: CallbackQuery):
     try:
         day = callback.data.split("_")[1]
@@ -429,7 +1020,7 @@ async def day_selected(callback: CallbackQuery):
         logger.error(f"Ошибка в day_selected: {e}")
         await callback.answer("Произошла ошибка. Попробуйте снова.")
 
-@dp.callback_query(lambda c: c.data.startswith("day_category_"))
+@router.callback_query(lambda c: c.data.startswith("day_category_"))
 async def show_category_options(callback: CallbackQuery):
     try:
         parts = callback.data.split("_")
@@ -448,32 +1039,22 @@ async def show_category_options(callback: CallbackQuery):
             items = sorted(groups.keys())
             text = "🏫 Выберите группу:"
             prefix = "group"
-            
-            # Обработка для групп (удаляем только дефисы)
-            def process_item(item):
-                return item.replace("-", "")
-                
+            # Для групп удаляем только дефисы
+            process_item = group_id
         else:
             items = sorted(teachers.keys())
             text = "👨‍🏫 Выберите преподавателя:"
             prefix = "teacher"
-            
-            # Обработка для преподавателей (создаем уникальный ключ)
-            def process_item(item):
-                # Используем хэш для длинных имен
-                return str(hash(item))[:16]
+            # Для преподавателей используем стабильный хэш имени
+            process_item = teacher_id
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[])
         
-        # Словарь для хранения соответствий
-        name_mapping = {}
-        
         for i in range(0, len(items), 2):
             row = items[i:i+2]
             buttons = []
             for item in row:
                 safe_key = process_item(item)
-                name_mapping[safe_key] = item  # Сохраняем соответствие
                 callback_data = f"day_final_{prefix}_{day}_{safe_key}"
                 
                 # Проверяем длину callback_data
@@ -486,9 +1067,6 @@ async def show_category_options(callback: CallbackQuery):
                 ))
             keyboard.inline_keyboard.append(buttons)
         
-        # Сохраняем mapping в user_state
-        user_state[callback.from_user.id]["name_mapping"] = name_mapping
-        
         await callback.message.edit_text(text, reply_markup=keyboard)
         await callback.answer()
         
@@ -496,7 +1074,7 @@ async def show_category_options(callback: CallbackQuery):
         logger.error(f"Ошибка в show_category_options: {str(e)}", exc_info=True)
         await callback.answer("❌ Произошла ошибка", show_alert=True)
 
-@dp.callback_query(lambda c: c.data.startswith("day_final_"))
+@router.callback_query(lambda c: c.data.startswith("day_final_"))
 async def show_final_schedule(callback: CallbackQuery):
     try:
         # Получаем данные из callback
@@ -509,13 +1087,9 @@ async def show_final_schedule(callback: CallbackQuery):
         day = parts[3]
         safe_key = '_'.join(parts[4:])
         
-        # Получаем сохраненные соответствия имен
-        name_mapping = user_state.get(callback.from_user.id, {}).get("name_mapping", {})
-        
-        # Восстанавливаем оригинальное имя
+        # Восстанавливаем оригинальное имя по таблицам идентификаторов реестра
         if entity_type == 'teacher':
-            # Для преподавателей используем сохраненное соответствие
-            original_name = name_mapping.get(safe_key)
+            original_name = teacher_ids.get(safe_key)
             if not original_name:
                 # Альтернативный поиск для совместимости
                 original_name = next(
@@ -528,24 +1102,23 @@ async def show_final_schedule(callback: CallbackQuery):
                 logger.error(f"Преподаватель не найден: {safe_key}")
                 await callback.answer("❌ Преподаватель не найден", show_alert=True)
                 return
-                
-            url = teachers[original_name]
         else:
             # Для групп используем прямое соответствие (без дефисов)
-            original_name = next(
-                (k for k in groups.keys() 
-                 if k.replace("-", "").lower() == safe_key.lower()),
-                None
-            )
+            original_name = group_ids.get(safe_key)
+            if not original_name:
+                original_name = next(
+                    (k for k in groups.keys() 
+                     if group_id(k).lower() == safe_key.lower()),
+                    None
+                )
             if not original_name:
                 await callback.answer("❌ Группа не найдена", show_alert=True)
                 return
-            url = groups[original_name]
         
         logger.info(f"Загружаем расписание для {original_name}")
 
         # Получаем расписание
-        schedule = await get_schedule(url)
+        schedule = await get_entity_schedule(entity_type, original_name)
         if not schedule:
             logger.error("Не удалось загрузить расписание")
             await callback.answer("❌ Расписание недоступно", show_alert=True)
@@ -571,20 +1144,21 @@ async def show_final_schedule(callback: CallbackQuery):
                 filtered.append(entry)
         
         # Формируем ответ
-        if not filtered:
-            response = f"📅 У {original_name} нет пар в {day.capitalize()}"
-        else:
-            response = f"📅 Расписание {original_name} на {day.capitalize()}:\n\n"
-            for entry in filtered:
-                response += f"  🕒 Пара {entry.get('pair_number', '?')} ({entry.get('pair_time', '')})\n"
-                if entity_type == 'group':
-                    response += f"      📚 Дисциплина: {entry.get('subject', 'Не указано')}\n"
-                    response += f"      🏫 Аудитория: {entry.get('classroom', 'Не указано')}\n"
-                    response += f"      👨‍🏫 Преподаватель: {entry.get('teacher', 'Не указано')}\n\n"
-                else:
-                    response += f"      📚 Дисциплина: {entry.get('teacher', 'Не указано')}\n"
-                    response += f"      👥 Группа: {entry.get('subject', 'Не указано')}\n"
-                    response += f"      🏫 Аудитория: {entry.get('classroom', 'Не указано')}\n\n"
+        with profile_stage("format"):
+            if not filtered:
+                response = f"📅 У {original_name} нет пар в {day.capitalize()}"
+            else:
+                response = f"📅 Расписание {original_name} на {day.capitalize()}:\n\n"
+                for entry in filtered:
+                    response += f"  🕒 Пара {entry.get('pair_number', '?')} ({entry.get('pair_time', '')})\n"
+                    if entity_type == 'group':
+                        response += f"      📚 Дисциплина: {entry.get('subject', 'Не указано')}\n"
+                        response += f"      🏫 Аудитория: {entry.get('classroom', 'Не указано')}\n"
+                        response += f"      👨‍🏫 Преподаватель: {entry.get('teacher', 'Не указано')}\n\n"
+                    else:
+                        response += f"      📚 Дисциплина: {entry.get('teacher', 'Не указано')}\n"
+                        response += f"      👥 Группа: {entry.get('subject', 'Не указано')}\n"
+                        response += f"      🏫 Аудитория: {entry.get('classroom', 'Не указано')}\n\n"
         
         # Отправляем результат
         await callback.message.edit_text(response, reply_markup=None)
@@ -594,8 +1168,48 @@ async def show_final_schedule(callback: CallbackQuery):
         logger.error(f"Ошибка в show_final_schedule: {str(e)}", exc_info=True)
         await callback.answer("❌ Произошла ошибка", show_alert=True)
 
+@router.callback_query(lambda c: c.data.startswith("fav_"))
+async def show_favorite_schedule(callback: CallbackQuery):
+    """Расписание избранного в одно нажатие: fav_<today|tomorrow|week>_<group|teacher>_<id>"""
+    try:
+        parts = callback.data.split("_", 3)
+        if len(parts) < 4:
+            await callback.answer("❌ Неверный формат данных", show_alert=True)
+            return
+
+        period, kind, entity_id = parts[1], parts[2], parts[3]
+        name = (group_ids if kind == 'group' else teacher_ids).get(entity_id)
+        if not name:
+            await callback.answer("❌ Группа или преподаватель не найдены", show_alert=True)
+            return
+
+        logger.info(f"Пользователь {callback.from_user.id} открыл избранное {name} ({period})")
+        schedule = await get_entity_schedule(kind, name)
+        if not schedule:
+            await callback.answer("❌ Расписание недоступно", show_alert=True)
+            return
+
+        if period == "week":
+            text = format_schedule(kind, f"📅 Расписание {name}:\n", schedule)
+        else:
+            day = datetime.now().date() + timedelta(days=1 if period == "tomorrow" else 0)
+            label = "сегодня" if period == "today" else "завтра"
+            entries = [entry for entry in schedule if parse_entry_date(entry['date']) == day]
+            if entries:
+                text = format_schedule(kind, f"📅 Расписание {name} на {label}:\n", entries)
+            else:
+                text = f"ℹ️ У {name} {label} нет пар"
+
+        for part in split_schedule(text):
+            await callback.message.answer(part)
+        await callback.answer()
+
+    except Exception as e:
+        logger.error(f"Ошибка в show_favorite_schedule: {str(e)}", exc_info=True)
+        await callback.answer("❌ Произошла ошибка", show_alert=True)
+
 # Обработчик нажатий на кнопки
-@dp.callback_query()
+@router.callback_query()
 async def process_callback(callback: types.CallbackQuery):
     try:
         data = callback.data
@@ -608,15 +1222,27 @@ async def process_callback(callback: types.CallbackQuery):
                 "📅 <b>Расписание:</b>\n"
                 "🔹 /schedule [группа] - Расписание группы на неделю\n"
                 "🔹 /teacher [ФИО] - Расписание преподавателя\n"
-                "🔹 /day [группа/ФИО] [день] - Расписание на конкретный день\n\n"
+                "🔹 /day [группа/ФИО] [день] - Расписание на конкретный день\n"
+                "🔹 /now [группа/ФИО] - Текущая пара\n"
+                "🔹 /next [группа/ФИО] - Следующая пара\n\n"
                 "📋 <b>Списки:</b>\n"
                 "🔹 /groups - Все доступные группы\n"
                 "🔹 /teachers - Все преподаватели\n\n"
+                "⭐ <b>Избранное:</b>\n"
+                "🔹 /fav [группа/ФИО] - Добавить в избранное (кнопки появятся в /start)\n"
+                "🔹 /unfav [группа/ФИО] - Удалить из избранного\n\n"
+                "🏫 <b>Аудитории:</b>\n"
+                "🔹 /room [аудитория] [источник] - Занятость аудитории сегодня\n"
+                "🔹 /free [пара] [источник] - Свободные аудитории\n"
+                "🔹 /sources - Источники расписания\n\n"
                 "📌 <b>Примеры:</b>\n"
                 "<code>/schedule СОД23-1</code>\n"
                 "<code>/teacher Волошин Р.Н.</code>\n"
                 "<code>/day ИСп21-2К пн</code>\n"
-                "<code>/day Григорян Н.А. среда</code>"
+                "<code>/day Григорян Н.А. среда</code>\n"
+                "<code>/now ИСп21-2К</code>\n"
+                "<code>/room 301</code>\n"
+                "<code>/free 3</code>"
             )
             
             # Проверяем, отличается ли новое сообщение от текущего
@@ -634,57 +1260,25 @@ async def process_callback(callback: types.CallbackQuery):
         elif data == "groups_list":
             # Проверяем, не открыт ли уже список групп
             if "Выберите группу" not in (callback.message.text or ""):
-                keyboard = InlineKeyboardMarkup(inline_keyboard=[])
-                group_buttons = []
-                for group in sorted(groups.keys()):
-                    group_buttons.append(InlineKeyboardButton(text=group, callback_data=f"group_{group}"))
-                    if len(group_buttons) == 3:
-                        keyboard.inline_keyboard.append(group_buttons)
-                        group_buttons = []
-                
-                if group_buttons:
-                    keyboard.inline_keyboard.append(group_buttons)
-                
-                await callback.message.edit_text("🏫 Выберите группу:", reply_markup=keyboard)
+                await callback.message.edit_text("🏫 Выберите группу:", reply_markup=groups_keyboard)
             else:
                 await callback.answer("Список групп уже открыт")
         
         elif data == "teachers_list":
             # Проверяем, не открыт ли уже список преподавателей
             if "Выберите преподавателя" not in (callback.message.text or ""):
-                keyboard = InlineKeyboardMarkup(inline_keyboard=[])
-                teacher_buttons = []
-                for teacher in sorted(teachers.keys()):
-                    teacher_buttons.append(InlineKeyboardButton(text=teacher, callback_data=f"teacher_{teacher}"))
-                    if len(teacher_buttons) == 2:
-                        keyboard.inline_keyboard.append(teacher_buttons)
-                        teacher_buttons = []
-                
-                if teacher_buttons:
-                    keyboard.inline_keyboard.append(teacher_buttons)
-                
-                await callback.message.edit_text("👨‍🏫 Выберите преподавателя:", reply_markup=keyboard)
+                await callback.message.edit_text("👨‍🏫 Выберите преподавателя:", reply_markup=teachers_keyboard)
             else:
                 await callback.answer("Список преподавателей уже открыт")
         
         elif data.startswith("group_"):
-            group_name = data[6:]
+            # Кнопки из старых сообщений содержат имя, а не идентификатор
+            group_name = group_ids.get(data[6:], data[6:])
             if group_name in groups:
-                group_url = groups[group_name]
-                schedule = await get_schedule(group_url)
+                schedule = await get_entity_schedule('group', group_name)
                 
                 if schedule:
-                    response = f"📅 Расписание для группы {group_name}:\n"
-                    current_date = None
-
-                    for entry in schedule:
-                        if entry['date'] != current_date:
-                            response += f"\n📅 <b>{entry['date']}</b>\n"
-                            current_date = entry['date']
-                        response += f"  🕒 Пара {entry['pair_number']} ({entry['pair_time']})\n"
-                        response += f"      📚 Дисциплина: {entry['subject']}\n"
-                        response += f"      🏫 Аудитория: {entry['classroom']}\n"
-                        response += f"      👨‍🏫 Преподаватель: {entry['teacher']}\n\n"
+                    response = format_schedule('group', f"📅 Расписание для группы {group_name}:\n", schedule)
 
                     schedule_parts = split_schedule(response)
                     await callback.message.edit_reply_markup(reply_markup=None)
@@ -698,23 +1292,12 @@ async def process_callback(callback: types.CallbackQuery):
                 await callback.answer("Группа не найдена.", show_alert=True)
         
         elif data.startswith("teacher_"):
-            teacher_name = data[8:]
+            teacher_name = teacher_ids.get(data[8:], data[8:])
             if teacher_name in teachers:
-                teacher_url = teachers[teacher_name]
-                schedule = await get_schedule(teacher_url)
+                schedule = await get_entity_schedule('teacher', teacher_name)
                 
                 if schedule:
-                    response = f"📅 Расписание для преподавателя {teacher_name}:\n"
-                    current_date = None
-
-                    for entry in schedule:
-                        if entry['date'] != current_date:
-                            response += f"\n📅 <b>{entry['date']}</b>\n"
-                            current_date = entry['date']
-                        response += f"  🕒 Пара {entry['pair_number']} ({entry['pair_time']})\n"
-                        response += f"      📚 Дисциплина: {entry['teacher']}\n"
-                        response += f"      👥 Группа: {entry['subject']}\n"
-                        response += f"      🏫 Аудитория: {entry['classroom']}\n\n"
+                    response = format_schedule('teacher', f"📅 Расписание для преподавателя {teacher_name}:\n", schedule)
 
                     schedule_parts = split_schedule(response)
                     await callback.message.edit_reply_markup(reply_markup=None)
@@ -735,7 +1318,7 @@ async def process_callback(callback: types.CallbackQuery):
 
 # Добавим в существующий код (после других команд)
 
-@dp.message(Command("day"))
+@router.message(Command("day"))
 async def day_schedule(message: Message):
     try:
         args = message.text.split()
@@ -768,19 +1351,19 @@ async def day_schedule(message: Message):
             return
 
         # Ищем цель (группу или преподавателя)
-        url = None
+        kind = None
         response_title = ""
         if target in groups:
-            url = groups[target]
+            kind = 'group'
             response_title = f"📅 Расписание группы {target} на {day_name}:\n"
         elif target in teachers:
-            url = teachers[target]
+            kind = 'teacher'
             response_title = f"📅 Расписание преподавателя {target} на {day_name}:\n"
         else:
             await message.reply("❌ Группа или преподаватель не найдены")
             return
 
-        schedule = await get_schedule(url)
+        schedule = await get_entity_schedule(kind, target)
         logger.info(f"Загружено расписание: {len(schedule)} записей")  # Логируем
 
         if not schedule:
@@ -799,33 +1382,283 @@ async def day_schedule(message: Message):
             return
 
         # Формируем ответ
-        response = response_title
-        current_date = None
+        response = format_schedule(kind, response_title, filtered)
 
-        for entry in filtered:
-            if entry['date'] != current_date:
-                response += f"\n📅 <b>{entry['date']}</b>\n"
-                current_date = entry['date']
+        await message.reply(response)
 
-            response += f"  🕒 Пара {entry['pair_number']} ({entry['pair_time']})\n"
-    
-            if target in groups:
-                response += f"      📚 Дисциплина: {entry['subject']}\n"
-                response += f"      🏫 Аудитория: {entry['classroom']}\n"
-                response += f"      👨‍🏫 Преподаватель: {entry['teacher']}\n\n"
-            else:
-                response += f"      📚 Дисциплина: {entry['teacher']}\n"
-                response += f"      👥 Группа: {entry['subject']}\n"
-                response += f"      🏫 Аудитория: {entry['classroom']}\n\n"
+    except Exception as e:
+        logger.error(f"Ошибка в /day: {str(e)}", exc_info=True)
+        await message.reply("⚠️ Произошла ошибка. Попробуйте позже")
+
+def pop_source_arg(args):
+    """Снимает с конца аргументов ID источника, если он указан"""
+    if len(args) > 1 and args[-1] in sources:
+        return sources[args.pop()]
+    return None
 
+@router.message(Command("sources"))
+async def list_sources(message: Message):
+    response = "🏛 Источники расписания:\n\n" + "\n".join(
+        f"  🔹 {source_id} — {source['title']}" for source_id, source in sources.items()
+    )
+    await message.reply(response)
+
+@router.message(Command("room"))
+async def room_schedule(message: Message):
+    try:
+        args = message.text.split()
+        source = pop_source_arg(args)
+        if len(args) < 2:
+            await message.reply("Используй команду так: /room <аудитория> [источник]")
+            return
+
+        room = args[1]
+        today = datetime.now().date()
+        logger.info(f"Пользователь {message.from_user.id} запросил занятость аудитории {room}.")
+
+        # Без явного источника ищем аудиторию во всех по порядку
+        candidates = [source] if source else list(sources.values())
+        source = next((c for c in candidates if room in get_room_index(c['id'])['counts']), None)
+        if not source:
+            await message.reply("❌ Аудитория не найдена в загруженных расписаниях")
+            return
+
+        pairs = get_room_index(source['id'])['days'].get((room, today), {})
+        if not pairs:
+            await message.reply(f"ℹ️ Аудитория {room} сегодня свободна")
+            return
+
+        time_table = get_time_table(today, source['time_tables'])
+        response = f"🏫 Аудитория {room} сегодня:\n\n"
+        for pair_number in sorted(pairs, key=natural_sort_key):
+            response += f"  🕒 Пара {pair_number} ({time_table.get(pair_number, '—')})\n"
+            response += format_occupants(pairs[pair_number])
         await message.reply(response)
 
     except Exception as e:
-        logger.error(f"Ошибка в /day: {str(e)}", exc_info=True)
+        logger.error(f"Ошибка в /room: {str(e)}", exc_info=True)
         await message.reply("⚠️ Произошла ошибка. Попробуйте позже")
 
+@router.message(Command("free"))
+async def free_rooms(message: Message):
+    try:
+        args = message.text.split()
+        source = pop_source_arg(args) or default_source()
+        now = datetime.now()
+        time_table = get_time_table(now, source['time_tables'])
+
+        if len(args) >= 2:
+            pair_number = args[1]
+            if pair_number not in time_table:
+                await message.reply(f"❌ Неверный номер пары. Сегодня пары с 1 по {len(time_table)}")
+                return
+            title = f"пару {pair_number}"
+        else:
+            pair_number, is_now = find_pair(now, source['time_tables'])
+            if not pair_number:
+                await message.reply("ℹ️ Пары на сегодня закончились")
+                return
+            title = f"пару {pair_number} (идёт сейчас)" if is_now else f"пару {pair_number} (следующая)"
+
+        logger.info(f"Пользователь {message.from_user.id} запросил свободные аудитории на пару {pair_number}.")
+
+        # Отвечаем только по полному индексу: иначе аудитория незапрошенной группы выглядит свободной
+        state = get_group_pages_state(source['id'])
+        if not state['loaded_at']:
+            await message.reply("⚠️ Расписания ещё загружаются, попробуйте позже")
+            return
+        if state['missing']:
+            await message.reply(
+                f"⚠️ Не удалось загрузить {state['missing']} расписаний групп, "
+                "список свободных аудиторий был бы неточным. Попробуйте позже"
+            )
+            return
+
+        index = get_room_index(source['id'])
+
+        occupied = index['slots'].get((now.date(), pair_number), {})
+        free = [room for room in index['sorted'] if room not in occupied]
+        if not free:
+            await message.reply(f"ℹ️ На {title} свободных аудиторий нет")
+            return
+
+        response = (
+            f"🏫 Свободные аудитории на {title}, {time_table[pair_number]}:\n\n"
+            + ", ".join(free)
+            + f"\n\nПо данным {sum(1 for s, _ in room_contributions.values() if s == source['id'])} загруженных расписаний"
+        )
+        for part in split_schedule(response):
+            await message.reply(part)
+
+    except Exception as e:
+        logger.error(f"Ошибка в /free: {str(e)}", exc_info=True)
+        await message.reply("⚠️ Произошла ошибка. Попробуйте позже")
+
+def resolve_entity(target):
+    """'group', 'teacher' или None, если такого имени нет в реестре"""
+    if target in groups:
+        return 'group'
+    if target in teachers:
+        return 'teacher'
+    return None
+
+async def get_today_lessons(kind, name, today):
+    """Занятия на сегодня: номер пары -> [записи]"""
+    lessons = {}
+    for entry in await get_entity_schedule(kind, name):
+        if entry['subject'] != "Нет пары" and parse_entry_date(entry['date']) == today:
+            lessons.setdefault(entry['pair_number'], []).append(entry)
+    return lessons
+
+async def parse_now_next_args(message, command):
+    """Разбирает аргумент /now и /next. Возвращает (тип, имя) или None, если уже ответили"""
+    target = " ".join(message.text.split()[1:])
+    if not target:
+        await message.reply(f"Используй команду так: /{command} <группа/преподаватель>")
+        return None
+    kind = resolve_entity(target)
+    if not kind:
+        await message.reply("❌ Группа или преподаватель не найдены")
+        return None
+    return kind, target
+
+@router.message(Command("now"))
+async def now_schedule(message: Message):
+    try:
+        parsed = await parse_now_next_args(message, "now")
+        if not parsed:
+            return
+        kind, target = parsed
+        logger.info(f"Пользователь {message.from_user.id} запросил текущую пару для {target}.")
+
+        now = datetime.now()
+        lessons = await get_today_lessons(kind, target, now.date())
+        time_tables = entity_source(kind, target)['time_tables']
+        _, intervals = get_pair_intervals(now, time_tables)
+        index, is_now = find_pair_index(now, time_tables)
+
+        if index is not None and is_now and intervals[index][2] in lessons:
+            interval = intervals[index]
+            await message.reply(f"▶️ {target} сейчас:\n" + describe_pair(kind, interval, lessons[interval[2]]))
+            return
+
+        # Сейчас пары нет — сразу подсказываем следующую
+        next_interval = find_next_lesson(intervals, lessons, index + 1 if is_now else index) if index is not None else None
+        if next_interval:
+            await message.reply(
+                f"ℹ️ У {target} сейчас нет пары. Следующая:\n"
+                + describe_pair(kind, next_interval, lessons[next_interval[2]])
+            )
+        else:
+            await message.reply(f"ℹ️ У {target} сейчас нет пары, и сегодня больше пар нет")
+
+    except Exception as e:
+        logger.error(f"Ошибка в /now: {str(e)}", exc_info=True)
+        await message.reply("⚠️ Произошла ошибка. Попробуйте позже")
+
+@router.message(Command("next"))
+async def next_schedule(message: Message):
+    try:
+        parsed = await parse_now_next_args(message, "next")
+        if not parsed:
+            return
+        kind, target = parsed
+        logger.info(f"Пользователь {message.from_user.id} запросил следующую пару для {target}.")
+
+        now = datetime.now()
+        lessons = await get_today_lessons(kind, target, now.date())
+        starts, intervals = get_pair_intervals(now, entity_source(kind, target)['time_tables'])
+        minutes = now.hour * 60 + now.minute
+
+        # Следующая — первая пара с занятием, которая ещё не началась
+        next_interval = find_next_lesson(intervals, lessons, bisect.bisect_right(starts, minutes))
+        if not next_interval:
+            await message.reply(f"ℹ️ У {target} сегодня больше пар нет")
+            return
+
+        await message.reply(
+            f"⏭ {target}, через {next_interval[0] - minutes} мин:\n"
+            + describe_pair(kind, next_interval, lessons[next_interval[2]])
+        )
+
+    except Exception as e:
+        logger.error(f"Ошибка в /next: {str(e)}", exc_info=True)
+        await message.reply("⚠️ Произошла ошибка. Попробуйте позже")
+
+@router.message(Command("fav"))
+async def add_favorite(message: Message):
+    user_id = str(message.from_user.id)
+    target = " ".join(message.text.split()[1:])
+    user_favorites = favorites.get(user_id, [])
+
+    if not target:
+        if not user_favorites:
+            await message.reply("⭐ Избранное пусто. Добавь: /fav <группа/преподаватель>")
+        else:
+            names = "\n".join(f"  ⭐ {name}" for _, name in user_favorites)
+            await message.reply(f"⭐ Избранное:\n{names}\n\nКнопки расписания — в /start")
+        return
+
+    kind = resolve_entity(target)
+    if not kind:
+        await message.reply("❌ Группа или преподаватель не найдены")
+        return
+    if [kind, target] in user_favorites:
+        await message.reply(f"⭐ {target} уже в избранном")
+        return
+    if len(user_favorites) >= MAX_FAVORITES:
+        await message.reply(f"❌ В избранном может быть не больше {MAX_FAVORITES} записей. Удали лишнее: /unfav <имя>")
+        return
+
+    favorites[user_id] = user_favorites + [[kind, target]]
+    save_favorites()
+    logger.info(f"Пользователь {user_id} добавил в избранное {target}")
+    await message.reply(f"⭐ {target} добавлен в избранное. Кнопки расписания — в /start")
+
+@router.message(Command("unfav"))
+async def remove_favorite(message: Message):
+    user_id = str(message.from_user.id)
+    target = " ".join(message.text.split()[1:])
+    if not target:
+        await message.reply("Используй команду так: /unfav <группа/преподаватель>")
+        return
+
+    user_favorites = [item for item in favorites.get(user_id, []) if item[1] != target]
+    if len(user_favorites) == len(favorites.get(user_id, [])):
+        await message.reply(f"❌ {target} нет в избранном")
+        return
+
+    if user_favorites:
+        favorites[user_id] = user_favorites
+    else:
+        favorites.pop(user_id, None)
+    save_favorites()
+    logger.info(f"Пользователь {user_id} удалил из избранного {target}")
+    await message.reply(f"✅ {target} удалён из избранного")
+
+@router.message(Command("profile"))
+async def profile_command(message: Message):
+    """/profile [секунды] [cpu] [mem] — только для администраторов из ADMIN_IDS"""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.reply("Неизвестная команда. Используй /help для списка команд.")
+        return
+
+    args = message.text.split()[1:]
+    seconds = 60
+    if args and args[0].isdigit():
+        seconds = min(int(args.pop(0)), 600)
+
+    if not start_profiling(seconds, with_cprofile="cpu" in args, with_tracemalloc="mem" in args):
+        await message.reply("⏱ Профилирование уже включено")
+        return
+    await message.reply(
+        f"⏱ Профилирование включено на {seconds} с. "
+        f"Обновления дольше {SLOW_UPDATE_MS} мс попадут в лог"
+        + (f", снимки будут сохранены в {PROFILE_DIR}" if "cpu" in args or "mem" in args else "")
+    )
+
 # Обработка неизвестных команд
-@dp.message()
+@router.message()
 async def handle_unknown_command(message: Message):
     await message.reply("Неизвестная команда. Используй /help для списка команд.")
 
@@ -834,11 +1667,99 @@ async def clear_cache_daily():
     schedule_cache = {}
     logger.info("Автоматическая очистка кэша расписания")
 
-# Запуск бота
-async def main():
+def log_startup_step(step):
+    logger.info(f"Запуск: {step} ({(time.monotonic() - STARTUP_STARTED) * 1000:.0f} мс)")
+
+async def registry_ready_middleware(handler, event, data):
+    """Обновления, пришедшие до загрузки реестра, ждут её, а не получают «не найдено»"""
+    if not registry_ready.is_set():
+        await registry_ready.wait()
+    return await handler(event, data)
+
+async def warm_up_cache():
+    """
+    Заранее загружает расписания из избранного (страницы групп загружает фоновый обход).
+    Одновременность запросов ограничивается для каждого хоста в fetch_page.
+    """
+    entities = {
+        (kind, name) for user_favorites in favorites.values() for kind, name in user_favorites
+        if name in (groups if kind == 'group' else teachers)
+    }
+    await asyncio.gather(*(get_entity_schedule(kind, name) for kind, name in entities))
+
+async def initialize(dispatcher):
+    """
+    Загружает реестр и избранное, запускает фоновые задачи и прогревает кэш.
+    Выполняется уже после начала опроса Telegram.
+    """
+    if not init_sources() or not reload_registry():
+        logger.error("Не удалось загрузить источники и реестр, бот останавливается")
+        await dispatcher.stop_polling()
+        return
+    registry_ready.set()
+    log_startup_step("реестр загружен")
+
+    load_favorites()
+
     # Запуск фоновой задачи очистки кэша
     asyncio.create_task(clear_cache_periodically())
-    
+    # Отслеживание изменений реестра и поиск новых групп на сайте
+    asyncio.create_task(watch_registry_files())
+    if any(source['discovery'] for source in sources.values()):
+        asyncio.create_task(discover_entities_periodically())
+    if ICS_PORT:
+        asyncio.create_task(refresh_ics_feeds_periodically())
+    # Обход страниц групп для индекса аудиторий (и выведенных расписаний преподавателей)
+    for source in sources.values():
+        asyncio.create_task(crawl_group_pages_periodically(source))
+
+    await warm_up_cache()
+    log_startup_step("кэш прогрет")
+
+async def on_startup(dispatcher):
+    log_startup_step("начат опрос Telegram")
+    asyncio.create_task(initialize(dispatcher))
+
+def create_app(token=None):
+    """
+    Создаёт бота и диспетчер. Токен проверяется здесь, а не при импорте модуля,
+    поэтому bot.py можно импортировать без него.
+    """
+    token = token or os.getenv('BOT_TOKEN')
+    if not token:
+        raise ValueError("Токен бота не указан. Добавьте BOT_TOKEN в .env файл")
+
+    bot = Bot(token=token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    dp = Dispatcher()
+    dp.include_router(router)
+    dp.update.outer_middleware(registry_ready_middleware)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(close_sessions)
+
+    # Хуки профилирования (пока профилирование выключено, почти ничего не стоят)
+    configure_profiling(PROFILE_DIR, SLOW_UPDATE_MS)
+    dp.update.outer_middleware(timing_middleware)
+    dp.message.middleware(handler_name_middleware)
+    dp.callback_query.middleware(handler_name_middleware)
+    bot.session.middleware(send_timing_middleware)
+    return bot, dp
+
+# Запуск бота
+async def main():
+    log_startup_step("модули импортированы")
+    bot, dp = create_app()
+    log_startup_step("бот создан")
+
+    # SIGUSR1 — замеры обновлений, SIGUSR2 — ещё и cProfile с tracemalloc
+    if hasattr(signal, 'SIGUSR1'):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, start_profiling, PROFILE_SIGNAL_SECONDS)
+        loop.add_signal_handler(signal.SIGUSR2, start_profiling, PROFILE_SIGNAL_SECONDS, True, True)
+
+    # Сервер календарей .ics
+    if ICS_PORT:
+        await start_ics_server()
+
     logger.info("Бот запущен.")
     await dp.start_polling(bot)
 
@@ -851,4 +1772,13 @@ async def clear_cache_periodically():
         logger.info("Автоматическая очистка кэша расписания")
 
 if __name__ == '__main__':
+    # python bot.py --check-teachers <каталог со страницами> [ID источника] — сверка выведенных расписаний
+    if len(sys.argv) in (3, 4) and sys.argv[1] == '--check-teachers':
+        if not init_sources() or not reload_registry():
+            sys.exit(1)
+        source_id = sys.argv[3] if len(sys.argv) == 4 else next(iter(sources))
+        if source_id not in sources:
+            print(f"Источник {source_id} не найден, есть: {', '.join(sources)}")
+            sys.exit(1)
+        sys.exit(check_teacher_fixtures(sys.argv[2], sources[source_id]))
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,134 @@
+"""
+Профилирование по запросу: замеры стадий обработки обновлений, cProfile и tracemalloc.
+
+Пока профилирование выключено, все хуки сводятся к проверке флага или контекстной переменной.
+"""
+import asyncio
+import contextvars
+import cProfile
+import logging
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Настраиваются из bot.py через configure_profiling
+profile_dir = "profiles"
+slow_update_ms = 500
+
+# Пока профилирование выключено, все хуки сводятся к проверке этого флага
+profiling_enabled = False
+# Профилировщики текущего сеанса (None, если не запрошены)
+active_cprofile = None
+active_tracemalloc = False
+# Время стадий обработки текущего обновления: стадия -> секунды
+profile_timings = contextvars.ContextVar('profile_timings', default=None)
+NO_PROFILE_STAGE = nullcontext()
+
+def configure_profiling(directory, slow_ms):
+    """Каталог для снимков и порог (в мс), начиная с которого обновление считается медленным"""
+    global profile_dir, slow_update_ms
+    profile_dir = directory
+    slow_update_ms = slow_ms
+
+@contextmanager
+def _timed_stage(timings, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - start
+
+def profile_stage(name):
+    """Замеряет стадию обработки (fetch/parse/format/send), если профилирование включено"""
+    timings = profile_timings.get()
+    if timings is None:
+        return NO_PROFILE_STAGE
+    return _timed_stage(timings, name)
+
+async def timing_middleware(handler, event, data):
+    """Внешний middleware: замеряет обработку обновления и пишет в лог медленные"""
+    if not profiling_enabled:
+        return await handler(event, data)
+
+    timings = {}
+    token = profile_timings.set(timings)
+    start = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        total_ms = (time.perf_counter() - start) * 1000
+        profile_timings.reset(token)
+        if total_ms >= slow_update_ms:
+            handler_name = timings.pop('handler', "—")
+            stages = ", ".join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in timings.items())
+            logger.warning(f"Медленное обновление {total_ms:.0f} мс: {handler_name} ({stages or 'без стадий'})")
+
+async def handler_name_middleware(handler, event, data):
+    """Внутренний middleware: запоминает, какой обработчик выбран для обновления"""
+    timings = profile_timings.get()
+    if timings is not None:
+        timings['handler'] = data['handler'].callback.__name__
+    return await handler(event, data)
+
+async def send_timing_middleware(make_request, bot, method):
+    """Middleware запросов к Bot API: время отправки ответов попадает в стадию send"""
+    with profile_stage("send"):
+        return await make_request(bot, method)
+
+def start_profiling(seconds, with_cprofile=False, with_tracemalloc=False):
+    """Включает профилирование на seconds секунд. Возвращает False, если оно уже включено"""
+    global profiling_enabled, active_cprofile, active_tracemalloc
+    if profiling_enabled:
+        return False
+
+    if with_cprofile:
+        active_cprofile = cProfile.Profile()
+        active_cprofile.enable()
+    if with_tracemalloc and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        active_tracemalloc = True
+    profiling_enabled = True
+    logger.info(f"Профилирование включено на {seconds} с (cProfile: {with_cprofile}, tracemalloc: {with_tracemalloc})")
+    asyncio.get_running_loop().call_later(seconds, stop_profiling)
+    return True
+
+def stop_profiling():
+    """Выключает профилирование и сохраняет снимки cProfile и tracemalloc в profile_dir"""
+    global profiling_enabled, active_cprofile, active_tracemalloc
+    profiling_enabled = False
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+
+    # Сначала выключаем сборщики, а уже потом работаем с файлами:
+    # ошибка записи не должна оставить cProfile включённым
+    cprofile, active_cprofile = active_cprofile, None
+    snapshot = None
+    try:
+        if cprofile:
+            cprofile.disable()
+        if active_tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+        if cprofile or snapshot:
+            os.makedirs(profile_dir, exist_ok=True)
+        if cprofile:
+            path = os.path.join(profile_dir, f"cprofile-{stamp}.prof")
+            cprofile.dump_stats(path)
+            logger.info(f"Профиль cProfile сохранён в {path}")
+        if snapshot:
+            path = os.path.join(profile_dir, f"tracemalloc-{stamp}.snapshot")
+            snapshot.dump(path)
+            logger.info(f"Снимок tracemalloc сохранён в {path}")
+    except OSError as e:
+        logger.error(f"Не удалось сохранить результаты профилирования: {e}")
+    finally:
+        if cprofile:
+            cprofile.disable()
+        if tracemalloc.is_tracing() and active_tracemalloc:
+            tracemalloc.stop()
+        active_tracemalloc = False
+        logger.info("Профилирование выключено")
@@ -0,0 +1,115 @@
+"""
+Источники расписания: у каждого свой сайт, реестр групп и преподавателей,
+сетка звонков, кодировка страниц и пул соединений.
+"""
+import asyncio
+import json
+import logging
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from timetable import build_time_tables
+
+logger = logging.getLogger(__name__)
+
+# Пауза после ошибки сервера (в секундах) удваивается с каждой ошибкой подряд
+INITIAL_BACKOFF = 5
+MAX_BACKOFF = 300
+
+# Состояние хостов: ограничение одновременных запросов и пауза после ошибок
+host_states = {}
+# Пулы соединений: ID источника -> aiohttp.ClientSession
+source_sessions = {}
+
+class HostUnavailable(Exception):
+    """Хост на паузе после ошибок — запрос к нему не отправляется"""
+
+def make_source(config, defaults):
+    """Источник из записи sources.json; пропущенные поля берутся из defaults"""
+    source = {**defaults, **config}
+    source['time_tables'] = build_time_tables(source['default_times'], source['monday_times'])
+    return source
+
+def load_sources(path, defaults):
+    """
+    Читает список источников из sources.json. Если файла нет, используется
+    единственный источник с настройками по умолчанию (groups.json, teachers.json
+    и общая сетка звонков).
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            configs = json.load(f)
+    except FileNotFoundError:
+        configs = [{}]
+
+    sources = {}
+    for config in configs:
+        source = make_source(config, defaults)
+        if source['id'] in sources:
+            raise ValueError(f"Источник {source['id']} указан в {path} дважды")
+        sources[source['id']] = source
+    return sources
+
+def get_host_state(url, source):
+    host = urlsplit(url).netloc
+    state = host_states.get(host)
+    if state is None:
+        state = host_states[host] = {
+            'semaphore': asyncio.Semaphore(source['max_concurrency']),
+            'backoff': 0,
+            'retry_at': 0.0,
+        }
+    return host, state
+
+def get_session(source):
+    """Пул соединений источника: медленный сервер не занимает соединения других"""
+    session = source_sessions.get(source['id'])
+    if session is None or session.closed:
+        session = source_sessions[source['id']] = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=source['max_concurrency']),
+            timeout=aiohttp.ClientTimeout(total=source['timeout'])
+        )
+    return session
+
+def mark_host_failed(host, state):
+    # Одновременные ошибки одной волны запросов считаются одной ошибкой
+    if time.monotonic() < state['retry_at']:
+        return
+    state['backoff'] = min(state['backoff'] * 2 or INITIAL_BACKOFF, MAX_BACKOFF)
+    state['retry_at'] = time.monotonic() + state['backoff']
+    logger.warning(f"Хост {host} недоступен, следующая попытка через {state['backoff']} с")
+
+async def fetch_page(url, source):
+    """
+    Загружает страницу через пул соединений источника и возвращает (статус, текст).
+    Одновременных запросов к хосту не больше max_concurrency источника; после
+    ошибки или ответа 5xx хост ставится на паузу, растущую с каждой ошибкой подряд.
+    """
+    host, state = get_host_state(url, source)
+    if time.monotonic() < state['retry_at']:
+        raise HostUnavailable(host)
+
+    async with state['semaphore']:
+        # Пока запрос ждал очереди, хост мог уйти на паузу
+        if time.monotonic() < state['retry_at']:
+            raise HostUnavailable(host)
+        try:
+            async with get_session(source).get(url) as response:
+                status = response.status
+                html = await response.text(encoding=source['encoding']) if status == 200 else None
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            mark_host_failed(host, state)
+            raise
+
+    if status >= 500:
+        mark_host_failed(host, state)
+    else:
+        state['backoff'] = 0
+    return status, html
+
+async def close_sessions():
+    for session in source_sessions.values():
+        await session.close()
+    source_sessions.clear()
@@ -0,0 +1,96 @@
+"""Поиск групп и преподавателей на индексных страницах — против локального стенда на aiohttp.web"""
+import asyncio
+
+from aiohttp import web
+
+import bot
+import sources
+
+GROUPS_PAGE = """
+<html><body>
+<a href="cg59.htm">СОД23-1</a>
+<a href="/archive/cg60.htm">СОД23-2К</a>
+<a href="news.htm">Новости</a>
+</body></html>
+"""
+
+TEACHERS_PAGE = """
+<html><body>
+<a href="cp67.htm">Азарян  А.А.</a>
+<a href="http://other.example/cp68.htm">Иванов И.И.</a>
+</body></html>
+"""
+
+async def start_stand(pages):
+    """Стенд сайта расписания: pages — {имя страницы: (статус, текст)}, можно менять на ходу"""
+    async def handler(request):
+        status, text = pages.get(request.match_info['page'], (404, ""))
+        return web.Response(status=status, body=text.encode('windows-1251'), content_type='text/html')
+
+    app = web.Application()
+    app.router.add_get('/{page}', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    source = sources.make_source({
+        'id': "stand",
+        'base_url': f"http://127.0.0.1:{port}/",
+        'index_pages': ["cg.htm", "cp.htm"],
+    }, bot.DEFAULT_SOURCE)
+    return runner, source
+
+def run_with_stand(pages, scenario):
+    async def main():
+        runner, source = await start_stand(pages)
+        try:
+            return await scenario(source)
+        finally:
+            await sources.close_sessions()
+            sources.host_states.clear()
+            await runner.cleanup()
+    return asyncio.run(main())
+
+def test_discover_entities_resolves_relative_urls():
+    pages = {'cg.htm': (200, GROUPS_PAGE), 'cp.htm': (200, TEACHERS_PAGE)}
+
+    async def scenario(source):
+        return source['base_url'], await bot.discover_entities(source)
+
+    base_url, results = run_with_stand(pages, scenario)
+    found_groups, _ = results[base_url + "cg.htm"]
+    _, found_teachers = results[base_url + "cp.htm"]
+    assert found_groups == {
+        "СОД23-1": base_url + "cg59.htm",
+        "СОД23-2К": base_url + "archive/cg60.htm",
+    }
+    assert found_teachers == {
+        "Азарян А.А.": base_url + "cp67.htm",
+        "Иванов И.И.": "http://other.example/cp68.htm",
+    }
+
+def test_discover_source_keeps_previous_results_of_failed_page(monkeypatch):
+    monkeypatch.setattr(bot, 'discovered_pages', {})
+    monkeypatch.setattr(bot, 'discovered_groups', {})
+    monkeypatch.setattr(bot, 'discovered_teachers', {})
+    pages = {'cg.htm': (200, GROUPS_PAGE), 'cp.htm': (200, TEACHERS_PAGE)}
+
+    async def scenario(source):
+        assert await bot.discover_source(source)
+        teachers_before = dict(bot.discovered_teachers["stand"])
+
+        # Страница преподавателей падает, на странице групп появилась новая группа
+        pages['cp.htm'] = (500, "")
+        pages['cg.htm'] = (200, GROUPS_PAGE + '<a href="cg61.htm">СОД24-1</a>')
+        assert await bot.discover_source(source)
+        assert bot.discovered_teachers["stand"] == teachers_before
+        assert "СОД24-1" in bot.discovered_groups["stand"]
+
+        # Пустая страница тоже не стирает найденное раньше
+        sources.host_states.clear()
+        pages['cp.htm'] = (200, "<html></html>")
+        assert not await bot.discover_source(source)
+        assert bot.discovered_teachers["stand"] == teachers_before
+
+    run_with_stand(pages, scenario)
@@ -0,0 +1,42 @@
+"""Сверка выведенных из страниц групп расписаний преподавателей с сохранёнными страницами"""
+import os
+
+import pytest
+
+import bot
+import sources
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "teachers")
+BASE_URL = "http://94.72.18.202:8083/"
+
+GROUPS = {
+    "СОД23-1": BASE_URL + "cg59.htm",
+    "ИСп21-1": BASE_URL + "cg97.htm",
+}
+TEACHERS = {
+    "Азарян А.А.": BASE_URL + "cp67.htm",
+    "Иванов И.И.": BASE_URL + "cp68.htm",
+}
+
+@pytest.fixture
+def source(monkeypatch):
+    source = sources.make_source({}, bot.DEFAULT_SOURCE)
+    monkeypatch.setattr(bot, 'sources', {source['id']: source})
+    yield source
+    bot.apply_registry(bot.build_registry({}, {}, {}, {}))
+
+def apply_fixture_registry(source, teachers):
+    url_sources = {url: source['id'] for url in [*GROUPS.values(), *teachers.values()]}
+    bot.apply_registry(bot.build_registry(GROUPS, teachers, url_sources, {}))
+
+def test_derived_schedules_match_teacher_pages(source, capsys):
+    apply_fixture_registry(source, TEACHERS)
+    assert bot.check_teacher_fixtures(FIXTURES_DIR, source) == 0
+    assert "Проверено преподавателей: 2, с расхождениями: 0" in capsys.readouterr().out
+
+def test_missing_lesson_is_reported(source, capsys):
+    apply_fixture_registry(source, {**TEACHERS, "Петров П.П.": BASE_URL + "cp69.htm"})
+    assert bot.check_teacher_fixtures(FIXTURES_DIR, source) == 1
+    out = capsys.readouterr().out
+    assert "Петров П.П. (cp69.htm): 1 расхождений" in out
+    assert "3 | Химия | 305 | ИСп21-1" in out
@@ -0,0 +1,448 @@
+"""
+Разбор страниц расписания и форматирование ответов.
+
+Модуль не зависит от aiogram и aiohttp, а BeautifulSoup импортируется только
+при первом разборе страницы, поэтому его можно импортировать в тестах и бенчмарках.
+"""
+import bisect
+import hashlib
+import logging
+import re
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import urljoin
+
+from profiling import profile_stage
+
+logger = logging.getLogger(__name__)
+
+default_times = {
+    "1": "8:30-10:00",
+    "2": "10:10-11:40",
+    "3": "12:10-13:40",
+    "4": "13:50-15:20",
+    "5": "15:30-17:00",
+    "6": "17:10-18:40"
+}
+
+monday_times = {
+    "1": "8:30-9:00",
+    "2": "9:10-10:30",
+    "3": "10:40-12:00",
+    "4": "12:20-13:40",
+    "5": "13:50-15:10",
+    "6": "16:00-17:20",
+    "7": "17:30-18:50"
+}
+
+DATE_RE = re.compile(r'(\d{1,2})\.(\d{1,2})\.(\d{2,4})')
+# Ссылки вида cg59.htm (группа) и cp67.htm (преподаватель)
+ENTITY_LINK_RE = re.compile(r'(?:^|/)(cg|cp)\d+\.htm$', re.IGNORECASE)
+
+def group_id(name):
+    """
+    Короткий идентификатор группы для callback_data (без дефисов). Слишком длинные
+    имена (например, дополненные источником) заменяются хэшем — callback_data
+    ограничена 64 байтами.
+    """
+    short_id = name.replace("-", "")
+    if len(short_id.encode('utf-8')) > 32:
+        return "g" + hashlib.md5(name.encode('utf-8')).hexdigest()[:16]
+    return short_id
+
+def teacher_id(name):
+    """Стабильный идентификатор преподавателя для callback_data (не зависит от перезапуска)"""
+    return hashlib.md5(name.encode('utf-8')).hexdigest()[:16]
+
+def get_weekday_name(offset=0):
+    """Возвращает 'пн', 'вт' и т.д. с учётом смещения дней"""
+    days = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
+    today = datetime.now() + timedelta(days=offset)
+    return days[today.weekday()]
+
+def parse_entry_date(date_text):
+    """Достаёт дату из строки вида '12.05.2025 Пн'. Возвращает None, если даты нет"""
+    match = DATE_RE.search(date_text or "")
+    if not match:
+        return None
+    day, month, year = (int(part) for part in match.groups())
+    if year < 100:
+        year += 2000
+    try:
+        return date(year, month, day)
+    except ValueError:
+        return None
+
+def parse_time_slot(slot):
+    """'8:30-10:00' -> ((8, 30), (10, 0)). Возвращает None для нераспознанных строк"""
+    try:
+        start, end = slot.split("-")
+        start_h, start_m = start.strip().split(":")
+        end_h, end_m = end.strip().split(":")
+        return (int(start_h), int(start_m)), (int(end_h), int(end_m))
+    except (ValueError, AttributeError):
+        return None
+
+def natural_sort_key(text):
+    """Естественная сортировка: '2' < '10' < '10а'"""
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', text)]
+
+def build_pair_intervals(time_table):
+    """
+    Сетка звонков в минутах от полуночи: список начал пар для bisect
+    и отсортированный список (начало, конец, номер пары).
+    """
+    intervals = []
+    for pair_number, slot in time_table.items():
+        parsed = parse_time_slot(slot)
+        if not parsed:
+            continue
+        (start_h, start_m), (end_h, end_m) = parsed
+        intervals.append((start_h * 60 + start_m, end_h * 60 + end_m, pair_number))
+    intervals.sort()
+    return [start for start, _, _ in intervals], intervals
+
+def build_time_tables(default, monday):
+    """Сетки звонков источника вместе с разобранными заранее интервалами"""
+    return {
+        'default_times': default,
+        'monday_times': monday,
+        'default_intervals': build_pair_intervals(default),
+        'monday_intervals': build_pair_intervals(monday),
+    }
+
+# Общая сетка звонков разбирается один раз при запуске
+DEFAULT_TIME_TABLES = build_time_tables(default_times, monday_times)
+
+def get_time_table(day, time_tables=DEFAULT_TIME_TABLES):
+    return time_tables['monday_times'] if day.weekday() == 0 else time_tables['default_times']
+
+def get_pair_intervals(day, time_tables=DEFAULT_TIME_TABLES):
+    return time_tables['monday_intervals'] if day.weekday() == 0 else time_tables['default_intervals']
+
+def find_pair_index(now, time_tables=DEFAULT_TIME_TABLES):
+    """
+    Индекс в сетке звонков: текущей пары или ближайшей следующей,
+    и идёт ли она сейчас. Если пары на сегодня закончились — (None, False).
+    """
+    starts, intervals = get_pair_intervals(now, time_tables)
+    minutes = now.hour * 60 + now.minute
+    index = bisect.bisect_right(starts, minutes) - 1
+    if index >= 0 and minutes < intervals[index][1]:
+        return index, True
+    if index + 1 < len(intervals):
+        return index + 1, False
+    return None, False
+
+def find_pair(now, time_tables=DEFAULT_TIME_TABLES):
+    """
+    Возвращает (номер пары, идёт ли она сейчас): текущую пару или
+    ближайшую следующую. Если пары на сегодня закончились — (None, False).
+    """
+    index, is_now = find_pair_index(now, time_tables)
+    if index is None:
+        return None, False
+    return get_pair_intervals(now, time_tables)[1][index][2], is_now
+
+def format_minutes(minutes):
+    return f"{minutes // 60}:{minutes % 60:02d}"
+
+def normalize_name(name):
+    return " ".join(name.split())
+
+def schedule_sort_key(entry):
+    return parse_entry_date(entry['date']) or date.max, natural_sort_key(entry['pair_number'])
+
+def invert_group_schedule(group_name, schedule):
+    """
+    Раскладывает записи группы по преподавателям. Записи получаются в том же
+    виде, что и на страницах преподавателей: в subject группа, в teacher дисциплина.
+    """
+    lessons = {}
+    for entry in schedule:
+        if entry['subject'] == "Нет пары" or entry['teacher'] == "—":
+            continue
+        lessons.setdefault(normalize_name(entry['teacher']), []).append({
+            'date': entry['date'],
+            'pair_number': entry['pair_number'],
+            'pair_time': entry['pair_time'],
+            'subject': group_name,
+            'classroom': entry['classroom'],
+            'teacher': entry['subject']
+        })
+    return lessons
+
+def merge_teacher_lessons(records):
+    """Сводит записи разных групп: пара у потока из нескольких групп становится одной записью"""
+    merged = {}
+    for record in records:
+        key = (record['date'], record['pair_number'], record['teacher'], record['classroom'])
+        if key in merged:
+            merged[key]['groups'].append(record['subject'])
+        else:
+            merged[key] = {**record, 'groups': [record['subject']]}
+
+    schedule = []
+    for record in merged.values():
+        record['subject'] = ", ".join(sorted(record.pop('groups'), key=natural_sort_key))
+        schedule.append(record)
+    schedule.sort(key=schedule_sort_key)
+    return schedule
+
+def lesson_keys(schedule):
+    """Занятия из записей в формате страницы преподавателя, без учёта порядка групп в потоке"""
+    return {
+        (
+            entry['date'],
+            entry['pair_number'],
+            entry['teacher'],
+            entry['classroom'],
+            ", ".join(sorted((group.strip() for group in entry['subject'].split(",")), key=natural_sort_key))
+        )
+        for entry in schedule
+        if entry['subject'] != "Нет пары"
+    }
+
+def compare_teacher_schedules(derived, actual):
+    """Возвращает список расхождений между выведенным и настоящим расписанием преподавателя"""
+    derived_keys = lesson_keys(derived)
+    actual_keys = lesson_keys(actual)
+    differences = [
+        f"нет в выведенном: {' | '.join(key)}" for key in actual_keys - derived_keys
+    ] + [
+        f"лишнее в выведенном: {' | '.join(key)}" for key in derived_keys - actual_keys
+    ]
+    return sorted(differences)
+
+def split_schedule(schedule_text, max_length=4096):
+    """
+    Разбивает текст расписания на части, каждая из которых не превышает max_length символов.
+    """
+    parts = []
+    while len(schedule_text) > max_length:
+        # Находим последний перенос строки до max_length
+        split_index = schedule_text.rfind('\n', 0, max_length)
+        if split_index == -1:
+            # Если перенос строки не найден, просто делим по max_length
+            split_index = max_length
+        parts.append(schedule_text[:split_index])
+        schedule_text = schedule_text[split_index:].lstrip()
+    parts.append(schedule_text)
+    return parts
+
+def parse_index_page(html, page_url):
+    """Извлекает ссылки на страницы групп (cgNN.htm) и преподавателей (cpNN.htm)"""
+    from bs4 import BeautifulSoup  # Тяжёлый импорт — только при первом разборе
+
+    found_groups = {}
+    found_teachers = {}
+    soup = BeautifulSoup(html, 'html.parser')
+    for link in soup.find_all('a', href=True):
+        match = ENTITY_LINK_RE.search(link['href'])
+        name = " ".join(link.text.split())
+        if not match or not name:
+            continue
+        url = urljoin(page_url, link['href'])
+        if match.group(1).lower() == 'cg':
+            found_groups[name] = url
+        else:
+            found_teachers[name] = url
+    return found_groups, found_teachers
+
+def parse_schedule_html(html, time_tables=DEFAULT_TIME_TABLES):
+    """
+    Разбирает страницу расписания (группы или преподавателя) в список записей.
+    Возвращает None, если на странице нет таблиц.
+    """
+    from bs4 import BeautifulSoup  # Тяжёлый импорт — только при первом разборе
+
+    soup = BeautifulSoup(html, 'html.parser')
+
+    tables = soup.find_all('table')
+    if not tables:
+        logger.warning("Таблицы на странице не найдены.")
+        return None
+
+    schedule = []
+    current_date = None
+
+    for table in tables:
+        rows = table.find_all('tr')
+        for row in rows[1:]:  # Пропускаем заголовок
+            cells = row.find_all('td')
+
+            if not cells:
+                continue
+
+            # Проверяем, является ли строка заголовком
+            is_header = any(
+                cell.text.strip() in ["День", "Пара", "&nbsp;"]
+                for cell in cells
+            )
+            if is_header:
+                continue  # Пропускаем заголовок
+
+            # Если строка содержит дату и день недели
+            if len(cells) >= 1 and cells[0].get('rowspan'):
+                current_date = cells[0].text.strip().replace('\n', ' ')
+                logger.info(f"Найдена дата: {current_date}")
+
+            # Определяем номер пары и ячейку с деталями
+            pair_number = None
+            details_cell = None
+            
+            if len(cells) >= 3:  # Строка с датой
+                pair_number = cells[1].text.strip()
+                details_cell = cells[2]
+            elif len(cells) >= 2:  # Обычная строка
+                pair_number = cells[0].text.strip()
+                details_cell = cells[1]
+            
+            if not pair_number or not details_cell or not details_cell.text.strip():
+                continue
+
+            # Извлекаем данные о паре
+            subject = details_cell.find('a', class_='z1')
+            classroom = details_cell.find('a', class_='z2')
+            teacher = details_cell.find('a', class_='z3')
+
+            # Определяем время пары
+            is_monday = current_date and ("Пн" in current_date or "понедельник" in current_date.lower())
+            time_table = time_tables['monday_times'] if is_monday else time_tables['default_times']
+            pair_time = time_table.get(pair_number, "—")
+
+            schedule.append({
+                'date': current_date,
+                'pair_number': pair_number,
+                'pair_time': pair_time,
+                'subject': subject.text.strip() if subject else "Нет пары",
+                'classroom': classroom.text.strip() if classroom else "—",
+                'teacher': teacher.text.strip() if teacher else "—"
+            })
+
+    return schedule
+
+def format_schedule(kind, title, entries):
+    """Текст расписания с заголовками по датам"""
+    with profile_stage("format"):
+        return _format_schedule(kind, title, entries)
+
+def _format_schedule(kind, title, entries):
+    response = title
+    current_date = None
+    for entry in entries:
+        if entry['date'] != current_date:
+            response += f"\n📅 <b>{entry['date']}</b>\n"
+            current_date = entry['date']
+        response += f"  🕒 Пара {entry['pair_number']} ({entry['pair_time']})\n"
+        if kind == 'group':
+            response += f"      📚 Дисциплина: {entry['subject']}\n"
+            response += f"      🏫 Аудитория: {entry['classroom']}\n"
+            response += f"      👨‍🏫 Преподаватель: {entry['teacher']}\n\n"
+        else:
+            response += f"      📚 Дисциплина: {entry['teacher']}\n"
+            response += f"      👥 Группа: {entry['subject']}\n"
+            response += f"      🏫 Аудитория: {entry['classroom']}\n\n"
+    return response
+
+def format_occupants(occupants):
+    """Одна строка на занятие; занятие со страниц группы и преподавателя выводится один раз"""
+    return "".join(
+        f"      👥 {group} — 👨‍🏫 {teacher}\n"
+        for group, teacher in sorted(set(occupants.values()))
+    )
+
+def format_lesson(kind, entry):
+    # На страницах преподавателей в поле teacher записана дисциплина, в subject — группа
+    if kind == 'group':
+        return f"📚 {entry['subject']}\n🏫 {entry['classroom']}\n👨‍🏫 {entry['teacher']}"
+    return f"📚 {entry['teacher']}\n👥 {entry['subject']}\n🏫 {entry['classroom']}"
+
+def describe_pair(kind, interval, entries):
+    start, end, pair_number = interval
+    return (
+        f"🕒 Пара {pair_number} ({format_minutes(start)}-{format_minutes(end)})\n"
+        + "\n\n".join(format_lesson(kind, entry) for entry in entries)
+    )
+
+def find_next_lesson(intervals, lessons, from_index):
+    """Первая пара с занятием, начиная с from_index в сетке звонков"""
+    for interval in intervals[from_index:]:
+        if interval[2] in lessons:
+            return interval
+    return None
+
+def ics_escape(text):
+    """Экранирование текста по RFC 5545"""
+    return (
+        text.replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\n", "\\n")
+    )
+
+def ics_fold(line):
+    """Переносит строки длиннее 75 байт, не разрывая символы UTF-8"""
+    parts = []
+    current = ""
+    limit = 75
+    for char in line:
+        if len((current + char).encode('utf-8')) > limit:
+            parts.append(current)
+            current = " "
+            limit = 75
+        current += char
+    parts.append(current)
+    return "\r\n".join(parts)
+
+def render_ics(kind, name, schedule, time_tables=DEFAULT_TIME_TABLES):
+    """Строит календарь .ics из записей get_schedule"""
+    dtstamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//schedule-bot//RU",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        f"X-WR-CALNAME:{ics_escape(f'Расписание {name}')}",
+    ]
+
+    for entry in schedule:
+        if entry['subject'] == "Нет пары":
+            continue
+        day = parse_entry_date(entry['date'])
+        if not day:
+            continue
+        # Время пары берём из сетки звонков по дню недели
+        time_table = get_time_table(day, time_tables)
+        slot = parse_time_slot(time_table.get(entry['pair_number'], ""))
+        if not slot:
+            continue
+        (start_h, start_m), (end_h, end_m) = slot
+        start = datetime(day.year, day.month, day.day, start_h, start_m)
+        end = datetime(day.year, day.month, day.day, end_h, end_m)
+
+        # На страницах преподавателей поля записи имеют другой смысл
+        if kind == 'group':
+            summary = entry['subject']
+            description = f"Преподаватель: {entry['teacher']}"
+        else:
+            summary = f"{entry['teacher']} ({entry['subject']})"
+            description = f"Группа: {entry['subject']}"
+        description = f"Пара {entry['pair_number']}. {description}"
+
+        uid_source = f"{kind}|{name}|{day.isoformat()}|{entry['pair_number']}|{summary}"
+        uid = hashlib.sha1(uid_source.encode('utf-8')).hexdigest()
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:{uid}@schedule-bot",
+            f"DTSTAMP:{dtstamp}",
+            f"DTSTART:{start.strftime('%Y%m%dT%H%M%S')}",
+            f"DTEND:{end.strftime('%Y%m%dT%H%M%S')}",
+            f"SUMMARY:{ics_escape(summary)}",
+            f"LOCATION:{ics_escape(entry['classroom'])}",
+            f"DESCRIPTION:{ics_escape(description)}",
+            "END:VEVENT",
+        ]
+
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(ics_fold(line) for line in lines) + "\r\n"